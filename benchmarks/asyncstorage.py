@@ -0,0 +1,41 @@
+"""
+A storage with the async methods used by ``eccollect --engine async``, for the
+benchmarks. Like ``benchmarks.storage.LatencyMixin``, it waits for
+``BENCHMARK_STORAGE_LATENCY`` seconds per operation, but it does so without
+blocking the event loop.
+
+This module requires Python 3.5 or later.
+
+"""
+from django.conf import settings
+import asyncio
+from .storage import LatencyCachedStorage, no_latency
+
+
+class AsyncLatencyMixin(object):
+    async def _async_wait(self):
+        await asyncio.sleep(getattr(settings, 'BENCHMARK_STORAGE_LATENCY', 0))
+
+    async def async_exists(self, name):
+        await self._async_wait()
+        with no_latency():
+            return super(AsyncLatencyMixin, self).exists(name)
+
+    async def async_modified_time(self, name):
+        await self._async_wait()
+        with no_latency():
+            return super(AsyncLatencyMixin, self).modified_time(name)
+
+    async def async_delete(self, name):
+        await self._async_wait()
+        with no_latency():
+            return super(AsyncLatencyMixin, self).delete(name)
+
+    async def async_save(self, name, content):
+        await self._async_wait()
+        with no_latency():
+            return super(AsyncLatencyMixin, self).save(name, content)
+
+
+class AsyncLatencyCachedStorage(AsyncLatencyMixin, LatencyCachedStorage):
+    pass
@@ -0,0 +1,320 @@
+"""
+Benchmarks ``eccollect``, ``createstaticmanifest`` and manifest lookups
+against synthetic static trees::
+
+    python -m benchmarks.run --files=1000,10000 --latency=0.001 --output=results.json
+
+Each size is benchmarked in a fresh process, against a tree generated from
+``--seed`` (and cached in ``--work-dir`` between runs). The destination is a
+local storage that sleeps for ``--latency`` seconds per round trip, standing in
+for a remote storage. Every timed scenario is run ``--repeat`` times; the
+fastest and median times are reported.
+
+"""
+from functools import partial
+from optparse import OptionParser
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+
+DEFAULT_SIZES = '1000,10000,100000'
+
+
+def get_parser():
+    parser = OptionParser(usage='python -m benchmarks.run [options]')
+    parser.add_option('--files', default=DEFAULT_SIZES,
+        help='A comma-separated list of tree sizes to benchmark. Defaults to'
+            ' %s.' % DEFAULT_SIZES)
+    parser.add_option('--seed', default=0, type='int',
+        help='The seed the trees are generated from.')
+    parser.add_option('--latency', default=0.0, type='float',
+        help='The number of seconds the destination storage waits for each'
+            ' operation.')
+    parser.add_option('--repeat', default=3, type='int',
+        help='The number of times each scenario is run.')
+    parser.add_option('--workers', default=1, type='int',
+        help='Passed to eccollect --workers.')
+    parser.add_option('--concurrency', default=100, type='int',
+        help='Passed to eccollect --concurrency, for the async engine.')
+    parser.add_option('--lookups', default=100000, type='int',
+        help='The number of manifest hits timed per manifest class.')
+    parser.add_option('--misses', default=1000, type='int',
+        help='The number of manifest misses timed per manifest class. Misses'
+            ' can be much slower than hits, so there are fewer of them.')
+    parser.add_option('--work-dir', default=None,
+        help='Where the trees are generated and collected. Defaults to a'
+            ' directory in the system temp dir, which is kept so that trees'
+            ' can be reused.')
+    parser.add_option('--output', default=None,
+        help='Write the results to this file, as JSON.')
+    parser.add_option('--child', default=False, action='store_true',
+        help='Benchmark a single size in this process and write the results'
+            ' to --output. Used internally.')
+    return parser
+
+
+def configure(work_dir, count, options):
+    from django.conf import settings
+    source_dir = os.path.join(work_dir, 'trees', '%s-%s' % (count, options.seed))
+    settings.configure(
+        DEBUG=False,
+        INSTALLED_APPS=['django.contrib.staticfiles', 'ecstatic'],
+        MIDDLEWARE_CLASSES=(),
+        CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                # Big enough for the whole manifest.
+                'OPTIONS': {'MAX_ENTRIES': 10 * max(count, 1000)},
+            },
+        },
+        STATIC_URL='/static/',
+        STATIC_ROOT=os.path.join(work_dir, 'collected'),
+        STATICFILES_DIRS=[source_dir],
+        # The collect scenarios post-process with CachedFilesMixin alone. With
+        # StaticManifestMixin, references would be looked up in a manifest
+        # that doesn't exist until createstaticmanifest has run.
+        STATICFILES_STORAGE='benchmarks.storage.LatencyCachedStorage',
+        ECSTATIC_MANIFEST_FILE=os.path.join(work_dir, 'manifest'),
+        ECSTATIC_COLLECT_HASH_INDEX=os.path.join(work_dir, 'hash-index.json'),
+        ECSTATIC_COLLECT_DEPENDENCY_INDEX=os.path.join(
+            work_dir, 'dependency-index.json'),
+        ECSTATIC_MANIFEST_EXTRAS=[],
+        BENCHMARK_STORAGE_LATENCY=options.latency,
+    )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    return source_dir
+
+
+def time_scenario(fn, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+    return times
+
+
+def summarize(count, scenario, times, **extra):
+    times = sorted(times)
+    result = {
+        'files': count,
+        'scenario': scenario,
+        'times': times,
+        'min': times[0],
+        'median': times[len(times) // 2],
+    }
+    result.update(extra)
+    return result
+
+
+def clear_destination():
+    from django.conf import settings
+    from django.core.cache import cache
+    if os.path.isdir(settings.STATIC_ROOT):
+        shutil.rmtree(settings.STATIC_ROOT)
+    for index_file in (settings.ECSTATIC_COLLECT_HASH_INDEX,
+                       settings.ECSTATIC_COLLECT_DEPENDENCY_INDEX):
+        if os.path.exists(index_file):
+            os.remove(index_file)
+    cache.clear()
+
+
+def benchmark_collect(count, options):
+    from django.core.management import call_command
+
+    results = []
+    for comparison_method in ('modified_time', 'file_hash'):
+        for pp in ('default', 'progressive', 'incremental'):
+            collect = partial(call_command, 'eccollect', interactive=False,
+                              verbosity=0, comparison_method=comparison_method,
+                              pp=pp, workers=options.workers)
+            name = 'eccollect --compare=%s --pp=%s' % (comparison_method, pp)
+            # A cold collect copies everything; a warm one (to the destination
+            # the last cold one left behind) only compares.
+            times = time_scenario(collect, options.repeat, clear_destination)
+            results.append(summarize(count, '%s (cold)' % name, times))
+            times = time_scenario(collect, options.repeat)
+            results.append(summarize(count, '%s (warm)' % name, times))
+
+    if sys.version_info >= (3, 5):
+        for storage in ('benchmarks.storage.LatencyCachedStorage',
+                        'benchmarks.asyncstorage.AsyncLatencyCachedStorage'):
+            collect = partial(call_command, 'eccollect', interactive=False,
+                              verbosity=0, engine='async',
+                              concurrency=options.concurrency,
+                              workers=options.workers,
+                              storage_override=storage)
+            name = 'eccollect --engine=async --storage=%s' % (
+                storage.rsplit('.', 1)[1])
+            times = time_scenario(collect, options.repeat, clear_destination)
+            results.append(summarize(count, '%s (cold)' % name, times))
+    return results
+
+
+def benchmark_createstaticmanifest(count, options):
+    from django.conf import settings
+    from django.core.management import call_command
+
+    def remove_manifest():
+        for path in (settings.ECSTATIC_MANIFEST_FILE,
+                     '%s.fingerprints' % settings.ECSTATIC_MANIFEST_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+
+    storage = 'benchmarks.storage.LatencyManifestStorage'
+    create = partial(call_command, 'createstaticmanifest', verbosity=0,
+                     storage_override=storage)
+    incremental = partial(create, incremental=True)
+    results = [summarize(count, 'createstaticmanifest',
+                         time_scenario(create, options.repeat, remove_manifest))]
+    incremental()
+    results.append(summarize(count, 'createstaticmanifest --incremental'
+                             ' (unchanged)',
+                             time_scenario(incremental, options.repeat)))
+    return results
+
+
+def benchmark_lookups(count, names, options):
+    from django.conf import settings
+    from ecstatic.manifests import NotInManifest, get_manifest_class
+    from ecstatic.utils import patched_settings
+
+    manifests = [
+        ('JsonManifest (cache)', 'ecstatic.manifests.JsonManifest', {}),
+        ('JsonManifest (snapshot)', 'ecstatic.manifests.JsonManifest',
+         {'ECSTATIC_MANIFEST_SNAPSHOT': True}),
+        ('BinaryManifest', 'ecstatic.manifests.BinaryManifest', {}),
+        ('SqliteManifest', 'ecstatic.manifests.SqliteManifest', {}),
+    ]
+    hits = [names[i % len(names)] for i in range(options.lookups)]
+    misses = ['%s.missing' % names[i % len(names)]
+              for i in range(options.misses)]
+
+    def get_all(manifest, keys):
+        for key in keys:
+            try:
+                manifest.get(key)
+            except NotInManifest:
+                pass
+
+    results = []
+    for label, import_path, overrides in manifests:
+        manifest_file = '%s.%s' % (settings.ECSTATIC_MANIFEST_FILE,
+                                   import_path.rsplit('.', 1)[1].lower())
+        with patched_settings(ECSTATIC_MANIFEST_FILE=manifest_file,
+                              **overrides):
+            manifest_class = get_manifest_class(import_path)
+            writer = manifest_class()
+            writer.clear()
+            for name in names:
+                writer.add(name, '/static/%s' % name)
+            writer.flush()
+
+            manifest = manifest_class()
+            # Let the manifest fill its cache or snapshot before timing.
+            get_all(manifest, hits[:1])
+            for kind, keys in (('hit', hits), ('miss', misses)):
+                times = time_scenario(partial(get_all, manifest, keys),
+                                      options.repeat)
+                result = summarize(count, '%s.get (%s)' % (label, kind), times)
+                result['ops_per_second'] = len(keys) / result['median']
+                results.append(result)
+    return results
+
+
+def run_child(count, options):
+    work_dir = os.path.join(options.work_dir, str(count))
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    source_dir = configure(work_dir, count, options)
+
+    from benchmarks.tree import generate_tree
+    names = generate_tree(source_dir, count, options.seed)
+
+    results = []
+    results.extend(benchmark_collect(count, options))
+    results.extend(benchmark_createstaticmanifest(count, options))
+    results.extend(benchmark_lookups(count, names, options))
+    return results
+
+
+def get_environment(options):
+    import django
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'seed': options.seed,
+        'latency': options.latency,
+        'repeat': options.repeat,
+        'workers': options.workers,
+        'concurrency': options.concurrency,
+    }
+
+
+def format_result(result):
+    line = '%8d  %-70s %9.3fs %9.3fs' % (result['files'], result['scenario'],
+                                         result['min'], result['median'])
+    if 'ops_per_second' in result:
+        line += '  %12.0f/s' % result['ops_per_second']
+    return line
+
+
+def main(argv=None):
+    options, args = get_parser().parse_args(argv)
+    if options.work_dir is None:
+        options.work_dir = os.path.join(tempfile.gettempdir(),
+                                        'ecstatic-benchmarks')
+    sizes = [int(size) for size in options.files.split(',')]
+
+    if options.child:
+        with open(options.output, 'w') as file:
+            json.dump(run_child(sizes[0], options), file)
+        return
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for count in sizes:
+        args = [sys.executable, '-m', 'benchmarks.run', '--child',
+                '--files=%s' % count, '--seed=%s' % options.seed,
+                '--latency=%s' % options.latency,
+                '--repeat=%s' % options.repeat,
+                '--workers=%s' % options.workers,
+                '--concurrency=%s' % options.concurrency,
+                '--lookups=%s' % options.lookups,
+                '--misses=%s' % options.misses,
+                '--work-dir=%s' % options.work_dir]
+        # The child's results are passed back in a file, so that anything
+        # printed while benchmarking can't get mixed up with them.
+        fd, results_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            subprocess.check_call(args + ['--output=%s' % results_file],
+                                  cwd=root)
+            with open(results_file) as file:
+                child_results = json.load(file)
+        finally:
+            os.remove(results_file)
+        for result in child_results:
+            print(format_result(result))
+            sys.stdout.flush()
+            results.append(result)
+
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump({'environment': get_environment(options),
+                       'results': results}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Storages that stand in for remote storage backends in the benchmarks.
+
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.staticfiles.storage import StaticFilesStorage
+from ecstatic.storage import CachedFilesMixin, StaticManifestMixin
+import threading
+import time
+
+
+_local = threading.local()
+
+
+@contextmanager
+def no_latency():
+    """
+    Skips the simulated latency for calls made by the current thread, for
+    callers that have already waited for it some other way.
+
+    """
+    _local.disabled = True
+    try:
+        yield
+    finally:
+        _local.disabled = False
+
+
+class LatencyMixin(object):
+    """
+    Sleeps for ``BENCHMARK_STORAGE_LATENCY`` seconds before every operation
+    that would be a round trip to a remote storage. URLs are generated
+    locally, as they are by most remote storage backends.
+
+    """
+    def _wait(self):
+        latency = getattr(settings, 'BENCHMARK_STORAGE_LATENCY', 0)
+        if latency and not getattr(_local, 'disabled', False):
+            time.sleep(latency)
+
+    def _open(self, name, mode='rb'):
+        self._wait()
+        return super(LatencyMixin, self)._open(name, mode)
+
+    def _save(self, name, content):
+        self._wait()
+        return super(LatencyMixin, self)._save(name, content)
+
+    def delete(self, name):
+        self._wait()
+        return super(LatencyMixin, self).delete(name)
+
+    def exists(self, name):
+        self._wait()
+        return super(LatencyMixin, self).exists(name)
+
+    def listdir(self, path):
+        self._wait()
+        return super(LatencyMixin, self).listdir(path)
+
+    def size(self, name):
+        self._wait()
+        return super(LatencyMixin, self).size(name)
+
+    def modified_time(self, name):
+        self._wait()
+        return super(LatencyMixin, self).modified_time(name)
+
+
+class LatencyStaticFilesStorage(LatencyMixin, StaticFilesStorage):
+    pass
+
+
+class LatencyCachedStorage(CachedFilesMixin, LatencyStaticFilesStorage):
+    pass
+
+
+class LatencyManifestStorage(StaticManifestMixin, LatencyCachedStorage):
+    pass
@@ -0,0 +1,120 @@
+"""
+Generates synthetic static file trees for the benchmarks.
+
+The trees are deterministic for a given file count and seed, so that results
+from different runs (and different machines) can be compared.
+
+"""
+import io
+import json
+import math
+import os
+import posixpath
+import random
+
+
+# (directory, extension, share of the files, median size in bytes)
+FILE_KINDS = [
+    ('img', 'png', 0.5, 4 * 1024),
+    ('js', 'js', 0.2, 6 * 1024),
+    ('css', 'css', 0.1, 3 * 1024),
+    ('fonts', 'woff', 0.05, 24 * 1024),
+    ('templates', 'html', 0.15, 1024),
+]
+
+FILES_PER_PACKAGE = 200
+MAX_FILE_SIZE = 512 * 1024
+POOL_SIZE = 2 * MAX_FILE_SIZE
+
+WORDS = ('static files storage manifest collect hash url style script font'
+         ' image body margin padding color background display block inline'
+         ' function return var this prototype').split()
+
+
+def _get_pools(rng):
+    binary = bytearray(rng.getrandbits(8) for _ in range(POOL_SIZE))
+    text = u' '.join(rng.choice(WORDS) for _ in range(POOL_SIZE // 5))
+    return bytes(binary), text.encode('ascii')[:POOL_SIZE]
+
+
+def _get_size(rng, median):
+    # File sizes are roughly log-normally distributed.
+    size = int(rng.lognormvariate(math.log(median), 1.0))
+    return max(16, min(size, MAX_FILE_SIZE))
+
+
+def _get_css(rng, name, size, referenced, text_pool):
+    out = io.BytesIO()
+    dir_name = posixpath.dirname(name)
+    count = 0
+    while out.tell() < size:
+        out.write(b'.c' + str(count).encode('ascii') + b' { ')
+        if referenced and rng.random() < 0.3:
+            target = posixpath.relpath(rng.choice(referenced), dir_name)
+            out.write(b'background: url("' + target.encode('utf-8') + b'"); ')
+        start = rng.randrange(POOL_SIZE - 80)
+        out.write(text_pool[start:start + rng.randrange(20, 80)])
+        out.write(b' }\n')
+        count += 1
+    return out.getvalue()
+
+
+def generate_tree(root, count, seed=0):
+    """
+    Creates ``count`` files under ``root`` (unless it already holds the tree
+    for that count and seed) and returns their names.
+
+    """
+    marker = os.path.join(root, '.benchmark-tree.json')
+    try:
+        with open(marker) as file:
+            data = json.load(file)
+        if data['count'] == count and data['seed'] == seed:
+            return data['names']
+    except (IOError, ValueError, KeyError):
+        pass
+
+    rng = random.Random(seed)
+    binary_pool, text_pool = _get_pools(rng)
+
+    kinds = []
+    for kind in FILE_KINDS:
+        kinds.extend([kind] * int(round(kind[2] * FILES_PER_PACKAGE)))
+
+    # CSS files are written last so that they can reference any of the images
+    # and fonts in their package.
+    names, stylesheets, referenced = [], [], {}
+    for index in range(count):
+        dir_name, ext, share, median = kinds[index % len(kinds)]
+        package = 'pkg%04d' % (index // FILES_PER_PACKAGE)
+        name = posixpath.join(package, dir_name, 'file%06d.%s' % (index, ext))
+        names.append(name)
+        if ext == 'css':
+            stylesheets.append((name, _get_size(rng, median)))
+            continue
+        if ext in ('png', 'woff'):
+            referenced.setdefault(package, []).append(name)
+            pool = binary_pool
+        else:
+            pool = text_pool
+        size = _get_size(rng, median)
+        start = rng.randrange(POOL_SIZE - size)
+        _write(root, name, pool[start:start + size])
+
+    for name, size in stylesheets:
+        package = name.split('/', 1)[0]
+        _write(root, name, _get_css(rng, name, size,
+                                    referenced.get(package, []), text_pool))
+
+    with open(marker, 'w') as file:
+        json.dump({'count': count, 'seed': seed, 'names': names}, file)
+    return names
+
+
+def _write(root, name, content):
+    path = os.path.join(root, *name.split('/'))
+    dir_name = os.path.dirname(path)
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    with open(path, 'wb') as file:
+        file.write(content)
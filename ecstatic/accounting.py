@@ -0,0 +1,114 @@
+"""
+Keeps count of the storage operations made by storages that extend
+``ecstatic.storage.OperationAccountingMixin``.
+
+Operations are recorded in every active ``OperationLog``. A log can cover the
+whole process (which is what management commands use, so that calls made in
+worker threads are included) or only the current thread (which is what the
+middleware uses, so that concurrent requests are counted separately).
+
+"""
+from contextlib import contextmanager
+import threading
+
+
+_lock = threading.Lock()
+_process_logs = []
+_local = threading.local()
+
+
+class OperationLog(object):
+    """
+    The number of calls to, and the total time spent in, each storage
+    operation. The time spent in an operation includes any operations it made
+    in turn (like the ``exists`` calls made by ``save``).
+
+    """
+    def __init__(self):
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        with self._lock:
+            count, total = self.operations.get(operation, (0, 0.0))
+            self.operations[operation] = (count + 1, total + seconds)
+
+    def update(self, log):
+        """
+        Adds the operations recorded in another log to this one.
+
+        """
+        with self._lock:
+            for operation, (count, total) in list(log.operations.items()):
+                old_count, old_total = self.operations.get(operation,
+                                                           (0, 0.0))
+                self.operations[operation] = (old_count + count,
+                                              old_total + total)
+
+    def count(self, operation=None):
+        """
+        Returns the number of calls to the named operation, or to all of them.
+
+        """
+        if operation is not None:
+            return self.operations.get(operation, (0, 0.0))[0]
+        return sum(count for count, total in self.operations.values())
+
+    def as_dict(self):
+        return dict((operation, {'count': count, 'seconds': total})
+                    for operation, (count, total) in self.operations.items())
+
+    def __str__(self):
+        if not self.operations:
+            return 'No storage operations.'
+        return ', '.join('%s: %d (%.3fs)' % (operation, count, total)
+                         for operation, (count, total)
+                         in sorted(self.operations.items()))
+
+
+def start_accounting(thread_only=False):
+    """
+    Returns a new ``OperationLog`` in which operations will be recorded until
+    it's passed to ``stop_accounting``. With ``thread_only``, only the
+    operations made by the current thread are recorded.
+
+    """
+    log = OperationLog()
+    if thread_only:
+        logs = getattr(_local, 'logs', None)
+        if logs is None:
+            logs = _local.logs = []
+        logs.append(log)
+    else:
+        with _lock:
+            _process_logs.append(log)
+    return log
+
+
+def stop_accounting(log):
+    logs = getattr(_local, 'logs', None)
+    if logs and log in logs:
+        logs.remove(log)
+    else:
+        with _lock:
+            if log in _process_logs:
+                _process_logs.remove(log)
+
+
+@contextmanager
+def accounting(thread_only=False):
+    log = start_accounting(thread_only)
+    try:
+        yield log
+    finally:
+        stop_accounting(log)
+
+
+def record_operation(operation, seconds):
+    for log in getattr(_local, 'logs', None) or ():
+        log.record(operation, seconds)
+    if _process_logs:
+        with _lock:
+            logs = list(_process_logs)
+        for log in logs:
+            log.record(operation, seconds)
@@ -9,4 +9,19 @@ class EcstaticConf(AppConf):
     MANIFEST_EXTRAS = ['admin/']
     USE_MANIFEST = not settings.DEBUG
     MANIFEST_CACHE = 'ecstatic_manifest' if 'ecstatic_manifest' in settings.CACHES else 'default'
+    MANIFEST_SNAPSHOT = False
+    MANIFEST_CHECK_INTERVAL = 0
+    MANIFEST_CACHE_CHUNK_SIZE = 1000
+    MANIFEST_FILL_LOCK_TIMEOUT = 60
     STRICT = False
+    POST_PROCESS_WORKERS = 1
+    HASH_ALGORITHM = 'md5'
+    HASH_CACHE_FILE = None
+    HASHED_NAME_VERIFY = None
+    ACCOUNTED_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+    COLLECT_HASH_INDEX = None
+    COLLECT_STATE_FILE = None
+    COLLECT_DEPENDENCY_INDEX = None
+    GZIP_EXTENSIONS = ['.css', '.js', '.json', '.svg', '.html', '.htm', '.txt',
+                       '.xml', '.map', '.ico', '.eot', '.otf', '.ttf']
+    GZIP_MIN_SIZE = 1024
@@ -0,0 +1,110 @@
+from django.conf import settings
+import logging
+import os
+import sqlite3
+import threading
+
+
+logger = logging.getLogger('ecstatic.hashcache')
+
+
+class FileHashCache(object):
+    """
+    A persistent cache of file hashes, stored in a SQLite database so that it
+    can be shared by every process on the machine. Entries are keyed by the
+    file's absolute path, size, modification time and inode, so a hash is
+    only reused as long as the file hasn't changed.
+
+    The cache is only an optimization, so it never gets in the way of hashing:
+    if the database can't be opened, read or written (for example, because
+    it's locked by another process for longer than ``timeout`` seconds), the
+    error is logged and the file is hashed as if it weren't cached.
+
+    """
+    table = 'ecstatic_file_hashes'
+    timeout = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _get_connection(self):
+        # SQLite connections can't be shared between threads or carried across
+        # a fork, so each thread of each process gets its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or connection[0] != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout)
+            try:
+                with db:
+                    db.execute('CREATE TABLE IF NOT EXISTS %s (path TEXT,'
+                               ' kind TEXT, size INTEGER, mtime_ns INTEGER,'
+                               ' inode INTEGER, hash TEXT NOT NULL,'
+                               ' PRIMARY KEY (path, kind))' % self.table)
+            except sqlite3.Error:
+                db.close()
+                raise
+            connection = (os.getpid(), db)
+            self._local.connection = connection
+        return connection[1]
+
+    def fingerprint(self, path):
+        """
+        Returns a tuple that changes whenever the file at ``path`` does.
+
+        """
+        stat = os.stat(path)
+        mtime_ns = getattr(stat, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(stat.st_mtime * 1000000000)
+        return (stat.st_size, mtime_ns, stat.st_ino)
+
+    def get(self, path, kind, fingerprint):
+        """
+        Returns the cached hash of the given kind for the file, or ``None`` if
+        there isn't one for this version of the file (or the cache can't be
+        read).
+
+        """
+        try:
+            row = self._get_connection().execute(
+                'SELECT size, mtime_ns, inode, hash FROM %s WHERE path = ? AND'
+                ' kind = ?' % self.table,
+                (os.path.abspath(path), kind)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Could not read the file hash cache %s: %s',
+                           self.path, e)
+            return None
+        if row is not None and tuple(row[:3]) == tuple(fingerprint):
+            return row[3]
+        return None
+
+    def set(self, path, kind, fingerprint, hash):
+        row = (os.path.abspath(path), kind) + tuple(fingerprint) + (hash,)
+        try:
+            connection = self._get_connection()
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO %s (path, kind, size, mtime_ns,'
+                    ' inode, hash) VALUES (?, ?, ?, ?, ?, ?)' % self.table,
+                    row)
+        except sqlite3.Error as e:
+            logger.warning('Could not write to the file hash cache %s: %s',
+                           self.path, e)
+
+
+_file_hash_cache = None
+
+
+def get_file_hash_cache():
+    """
+    Returns the ``FileHashCache`` for ``ECSTATIC_HASH_CACHE_FILE``, or ``None``
+    if the setting isn't set.
+
+    """
+    global _file_hash_cache
+    path = settings.ECSTATIC_HASH_CACHE_FILE
+    if not path:
+        return None
+    if _file_hash_cache is None or _file_hash_cache.path != path:
+        _file_hash_cache = FileHashCache(path)
+    return _file_hash_cache
@@ -0,0 +1,216 @@
+"""
+The engine behind ``eccollect --engine async``. It compares and transfers files
+on an asyncio event loop, with up to ``--concurrency`` files in flight at once.
+
+Destination storages can provide coroutine methods named ``async_exists``,
+``async_modified_time``, ``async_delete`` and ``async_save`` (with the same
+arguments and return values as their synchronous counterparts). The
+synchronous methods of storages that don't are called in a thread pool.
+
+Either way, the calls are counted towards the same ``--stats-json`` phases as
+with the default engine.
+
+This module requires Python 3.5 or later.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+from ..accounting import record_operation
+from ..storage import OperationAccountingMixin
+
+
+ASYNC_METHODS = ('exists', 'modified_time', 'delete', 'save')
+
+
+class AsyncCollector(object):
+    """
+    Collects files for an eccollect command, following the same steps as its
+    ``copy_file`` and ``delete_file`` methods. Everything but the calls to
+    the destination storage's async methods (which are awaited) and the
+    comparison of modified times runs in a thread pool, so that hashing and
+    reading local files doesn't block the event loop. Post-processing happens
+    one file at a time.
+
+    """
+    def __init__(self, command, do_post_process):
+        self.command = command
+        self.do_post_process = do_post_process
+
+    def run(self, found_files):
+        command = self.command
+        workers = (command.workers if command.workers > 1
+                   else min(command.concurrency, 32))
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            loop.run_until_complete(self.collect(found_files, loop, executor))
+        finally:
+            executor.shutdown(wait=True)
+            loop.close()
+
+    async def collect(self, found_files, loop, executor):
+        self.loop = loop
+        self.executor = executor
+        self.storage = self.command.storage
+        self.native = all(hasattr(self.storage, 'async_%s' % name)
+                          for name in ASYNC_METHODS)
+        self.semaphore = asyncio.Semaphore(self.command.concurrency)
+        self.post_process_lock = asyncio.Lock()
+        self.tasks = set()
+        self.error = None
+
+        for prefixed_path, (source_storage, path) in found_files.items():
+            await self.semaphore.acquire()
+            if self.error is not None:
+                self.semaphore.release()
+                break
+            task = asyncio.ensure_future(
+                self.collect_file(path, prefixed_path, source_storage))
+            self.tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        if self.error is not None:
+            raise self.error
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        self.semaphore.release()
+        if not task.cancelled() and task.exception() is not None:
+            if self.error is None:
+                self.error = task.exception()
+
+    async def call(self, phase, fn, *args):
+        """
+        Calls ``fn`` in the thread pool, in the named stats phase.
+
+        """
+        def run():
+            with self.command.stats.phase(phase):
+                return fn(*args)
+        return await self.loop.run_in_executor(self.executor, run)
+
+    async def storage_call(self, phase, operation, *args):
+        """
+        Calls the destination storage's ``async_`` version of the named
+        operation or, if it doesn't have them, the synchronous one in the
+        thread pool, counting the call towards the named stats phase.
+
+        """
+        if not self.native:
+            return await self.call(phase, getattr(self.storage, operation),
+                                   *args)
+
+        # The call is awaited on the event loop, along with everybody else's,
+        # so it has to be recorded explicitly.
+        start = time.time()
+        try:
+            return await getattr(self.storage, 'async_%s' % operation)(*args)
+        finally:
+            elapsed = time.time() - start
+            self.command.stats.record_operation(phase, operation, elapsed)
+            if isinstance(self.storage, OperationAccountingMixin):
+                record_operation(operation, elapsed)
+
+    async def collect_file(self, path, prefixed_path, source_storage):
+        command = self.command
+        command.stats.count(files=1, phase='transfer')
+        if await self.call('transfer', command._skip_file, path,
+                           prefixed_path, source_storage):
+            return
+
+        attempt = 0
+        while True:
+            try:
+                await self.copy_file(path, prefixed_path, source_storage)
+            except command._get_transient_errors() as e:
+                if attempt >= command.retries:
+                    command._file_failed(path, prefixed_path, e)
+                    return
+                await asyncio.sleep(command._get_retry_delay(path, attempt, e))
+                attempt += 1
+            else:
+                break
+        await self.call('transfer', command._file_done, path, prefixed_path,
+                        source_storage)
+
+        if command.progressive_post_process and self.do_post_process:
+            async with self.post_process_lock:
+                await self.call('transfer', command._file_collected, path,
+                                prefixed_path, source_storage,
+                                self.do_post_process)
+
+    async def copy_file(self, path, prefixed_path, source_storage):
+        command = self.command
+        if prefixed_path in command.copied_files:
+            return command.log(u"Skipping '%s' (already copied earlier)"
+                               % path)
+        if not await self.delete_file(path, prefixed_path, source_storage):
+            return
+        source_path = source_storage.path(path)
+        if command.dry_run:
+            command.log(u"Pretending to copy '%s'" % source_path, level=1)
+        else:
+            command.log(u"Copying '%s'" % source_path, level=1)
+            source_file = await self.call('transfer', source_storage.open,
+                                          path)
+            try:
+                await self.storage_call('transfer', 'save', prefixed_path,
+                                        source_file)
+            finally:
+                source_file.close()
+        if prefixed_path not in command.copied_files:
+            command.copied_files.append(prefixed_path)
+            await self.call('transfer', command._file_copied, path,
+                            prefixed_path, source_storage)
+
+    async def delete_file(self, path, prefixed_path, source_storage):
+        """
+        Deletes the destination file if it needs to be replaced. Returns
+        whether the file should be copied.
+
+        """
+        command = self.command
+        phase = 'compare:%s' % command.comparison_method
+        command.stats.count(files=1, phase=phase)
+
+        if command.destination_listing is not None:
+            exists = command._destination_exists(prefixed_path)
+        else:
+            exists = await self.storage_call(phase, 'exists', prefixed_path)
+        if not exists:
+            return True
+
+        by_modified_time = command.comparison_method == 'modified_time'
+        if by_modified_time and command.destination_listing is None:
+            should_delete = await self.compare_modified_time(
+                phase, path, prefixed_path, source_storage)
+        else:
+            should_delete = await self.call(phase, command.compare, path,
+                                            prefixed_path, source_storage)
+
+        if not should_delete:
+            if prefixed_path not in command.unmodified_files:
+                command.unmodified_files.append(prefixed_path)
+            command.log(u"Skipping '%s' (not modified)" % path)
+            return False
+
+        if command.dry_run:
+            command.log(u"Pretending to delete '%s'" % path)
+        else:
+            command.log(u"Deleting '%s'" % path)
+            await self.storage_call(phase, 'delete', prefixed_path)
+        return True
+
+    async def compare_modified_time(self, phase, path, prefixed_path,
+                                    source_storage):
+        try:
+            target_last_modified = await self.storage_call(
+                phase, 'modified_time', prefixed_path)
+            source_last_modified = source_storage.modified_time(path)
+        except (OSError, NotImplementedError, AttributeError):
+            return True
+        return self.command._is_modified(prefixed_path, target_last_modified,
+                                         source_last_modified)
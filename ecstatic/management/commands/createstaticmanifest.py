@@ -1,10 +1,12 @@
 from django.conf import settings
-from django.contrib.staticfiles import finders
 from django.core.management.base import NoArgsCommand
-from django.utils.datastructures import SortedDict
+from optparse import make_option
+import json
 import os
-from ..utils import StorageOverrideMixin
+from ..utils import (StorageOverrideMixin, find_duplicates, find_static_files,
+                     get_stored_name)
 from ...manifests import ConfiguredStaticFilesManifest
+from ...utils import atomic_write, get_file_hash, get_gzip_url
 
 
 class Command(StorageOverrideMixin, NoArgsCommand):
@@ -12,37 +14,161 @@ class Command(StorageOverrideMixin, NoArgsCommand):
     Creates a staticfiles manifest. The exact format of the manifest is defined
     by ``ECSTATIC_MANIFEST``. By default, it's a JSON file.
 
+    With ``--dedupe``, files that ``eccollect --dedupe`` didn't collect because
+    they're identical to another file are given that file's URL.
+
+    With ``--incremental``, URLs are only generated for files that have been
+    added or changed since the last run (as recorded in a ``.fingerprints``
+    file next to the manifest); the other entries are carried over.
+
     """
     help = 'Creates a file that maps static file names to their URLs.'
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--incremental', default=False,
+            action='store_true', dest='incremental',
+            help='Only generate URLs for files that are new or have changed'
+                ' since the manifest was last created, reusing the existing'
+                ' entries for the others.'),
+        make_option('--dedupe', default=False,
+            action='store_true', dest='dedupe',
+            help='Give files with identical contents the URL of the first'
+                ' of them, to match eccollect --dedupe.'),
+    )
+
     def handle_noargs(self, **options):
         self.set_options(**options)
 
-        found_files = SortedDict()
         manifest = ConfiguredStaticFilesManifest()
+
+        existing = self.load_existing(manifest)
+        fingerprints = {}
+        if options.get('incremental'):
+            fingerprints = self.load_fingerprints()
+
         manifest.clear()
 
         ignore_patterns = getattr(settings, 'ECSTATIC_MANIFEST_EXCLUDES', [])
 
-        for finder in finders.get_finders():
-            for path, storage in finder.list(ignore_patterns):
-                # Prefix the relative path if the source storage contains it
-                if getattr(storage, 'prefix', None):
-                    prefixed_path = os.path.join(storage.prefix, path)
-                else:
-                    prefixed_path = path
-
-                if prefixed_path not in found_files:
-                    found_files[prefixed_path] = path
-
-        for path in found_files.values() + settings.ECSTATIC_MANIFEST_EXTRAS:
-            try:
-                generate_url = self.storage.generate_url
-            except AttributeError:
-                raise AttributeError('%s doesn\'t define a generate_url method.'
-                        ' Did you remember to extend StaticManifestMixin?' %
-                        self.storage)
-            hashed_name = generate_url(path)
-            manifest.add(path, hashed_name)
+        found_files = find_static_files(ignore_patterns)
+
+        try:
+            generate_url = self.storage.generate_url
+        except AttributeError:
+            raise AttributeError('%s doesn\'t define a generate_url method.'
+                    ' Did you remember to extend StaticManifestMixin?' %
+                    self.storage)
+
+        # Maps the prefixed path of each duplicate to that of the file whose
+        # URL it gets.
+        aliases = {}
+        if options.get('dedupe'):
+            aliases = find_duplicates(found_files, self.storage, get_md5)
+
+        urls = {}
+        prefixed_paths = {}
+        new_fingerprints = {}
+        for prefixed_path, (storage, path) in found_files.items():
+            if prefixed_path in aliases:
+                continue
+            prefixed_paths[path] = prefixed_path
+            fingerprint = self.get_fingerprint(storage, path)
+            unchanged = fingerprint is not None and path in existing
+            if unchanged and fingerprints.get(path) == fingerprint:
+                urls[path] = existing[path]
+            else:
+                urls[path] = generate_url(path)
+            if fingerprint is not None:
+                new_fingerprints[path] = fingerprint
+
+        for path in settings.ECSTATIC_MANIFEST_EXTRAS:
+            urls[path] = generate_url(path)
+
+        # Keep the entries for gzipped variants recorded by ``eccollect
+        # --gzip``. They're still right if the file's URL hasn't changed;
+        # otherwise, they're only kept if the variant of the file now being
+        # served exists.
+        for name in existing:
+            path = name[:-3]
+            if not name.endswith('.gz') or name in urls or path not in urls:
+                continue
+            if urls[path] == existing.get(path):
+                urls[name] = existing[name]
+            elif self.storage.exists('%s.gz' % get_stored_name(
+                    self.storage, prefixed_paths.get(path, path))):
+                urls[name] = get_gzip_url(urls[path])
+
+        for prefixed_path, canonical in aliases.items():
+            path = found_files[prefixed_path][1]
+            canonical_path = found_files[canonical][1]
+            if path == canonical_path:
+                # The canonical file's entry is the duplicate's too.
+                continue
+            urls[path] = urls[canonical_path]
+            if '%s.gz' % canonical_path in urls:
+                urls['%s.gz' % path] = urls['%s.gz' % canonical_path]
+
+        for path, url in urls.items():
+            manifest.add(path, url)
 
         manifest.flush()
+        self.save_fingerprints(new_fingerprints)
+
+    def load_existing(self, manifest):
+        """
+        Returns the entries of the current manifest, or an empty dict if the
+        manifest class can't load them. (Manifest classes written before
+        ``load`` was added only have ``clear``, ``add``, ``flush`` and
+        ``get``.)
+
+        """
+        load = getattr(manifest, 'load', None)
+        if load is None:
+            return {}
+        try:
+            return load()
+        except NotImplementedError:
+            return {}
+
+    def get_fingerprint(self, storage, path):
+        """
+        Returns a value that changes whenever the source file does, or ``None``
+        if the file isn't local.
+
+        """
+        try:
+            stat = os.stat(storage.path(path))
+        except (NotImplementedError, OSError):
+            return None
+        return [stat.st_size, stat.st_mtime]
+
+    def get_fingerprints_file(self):
+        return '%s.fingerprints' % settings.ECSTATIC_MANIFEST_FILE
+
+    def load_fingerprints(self):
+        """
+        Loads the fingerprints of the source files as of the last time the
+        manifest was created for the current storage.
+
+        """
+        try:
+            with open(self.get_fingerprints_file()) as file:
+                data = json.load(file)
+        except (IOError, ValueError):
+            return {}
+        if data.get('storage') != self.get_storage_id():
+            return {}
+        return data.get('files', {})
+
+    def save_fingerprints(self, fingerprints):
+        data = {'storage': self.get_storage_id(), 'files': fingerprints}
+        with atomic_write(self.get_fingerprints_file(), 'w') as file:
+            json.dump(data, file, sort_keys=True)
+
+
+def get_md5(storage, path, prefixed_path):
+    file = storage.open(path)
+    try:
+        return get_file_hash(file, 'md5')
+    finally:
+        file.close()
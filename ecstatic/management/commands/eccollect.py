@@ -1,13 +1,27 @@
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import json
 import os
 import sys
+import threading
+import time
 
+from django.conf import settings
 from django.contrib.staticfiles.management.commands.collectstatic import Command as CollectStatic
+from django.core.files.base import ContentFile
 from django.core.management.base import CommandError
-from django.contrib.staticfiles import finders
 from django.utils.datastructures import SortedDict
-from hashlib import md5
+from django.contrib.staticfiles.utils import matches_patterns
 from optparse import make_option
-from ..utils import StorageOverrideMixin
+from ..utils import (PathList, StorageOverrideMixin, find_duplicates,
+                     find_file_references, find_static_files,
+                     get_stored_name)
+from ...manifests import ConfiguredStaticFilesManifest
+from ...stats import CollectStats
+from ...storage import get_bulk_listing
+from ...utils import (atomic_write, compress_file, get_file_hash,
+                      get_gzip_url)
 
 
 class CollectNewMixin(object):
@@ -17,6 +31,21 @@ class CollectNewMixin(object):
         'mtime': 'modified_time',
     }
 
+    # Holds the log messages of files being collected in worker threads.
+    _log_buffer = threading.local()
+
+    # The number of seconds to wait before the first retry of a failed file.
+    retry_delay = 1
+
+    # The errors after which a file is retried. Storages can replace these
+    # with a ``transient_errors`` attribute of their own. Other errors abort
+    # the collect right away.
+    transient_errors = (IOError, OSError)
+
+    # The number of files in a row that can fail (after being retried) before
+    # the collect is aborted, since the problem probably isn't the files.
+    max_consecutive_failures = 10
+
     def __init__(self, *args, **kwargs):
         self.option_list = list(self.option_list) + [
             make_option('--compare', default='modified_time',
@@ -25,18 +54,105 @@ class CollectNewMixin(object):
                     ' file is newer. Options are modified_time/mtime and'
                     ' file_hash/md5. Note that, with file_hash, the file will'
                     ' be opened if the storage does not define a file_hash'
-                    ' method, so you should define a file_hash method for'
-                    ' remote storage backends (or avoid the file_hash'
-                    ' comparison method). The modified_time method must return'
-                    ' a local datetime; file_hash must return an md5'
-                    ' hexdigest.'),
+                    ' method (or it returns None) and the file isn\'t in'
+                    ' ECSTATIC_COLLECT_HASH_INDEX, so you should define a'
+                    ' file_hash method for remote storage backends (or avoid'
+                    ' the file_hash comparison method). The modified_time'
+                    ' method must return a local datetime; file_hash must'
+                    ' return an md5 hexdigest.'),
             make_option('--pp', default='default',
                 action="store", dest='pp', type="string",
                 help='The default behavior of collectstatic is to collect'
                     ' the files first then batch post-process them.'
                     ' Ommiting the --pp option or passing it default produces'
                     ' this default behavior. Passing in progressive will'
-                    ' post-process each individual file after it\'s collected')
+                    ' post-process each individual file after it\'s collected.'
+                    ' Passing in incremental will, after collecting, only'
+                    ' post-process the files that were collected and the'
+                    ' files that (directly or indirectly) reference them,'
+                    ' according to the index saved by the previous'
+                    ' incremental run (see'
+                    ' ECSTATIC_COLLECT_DEPENDENCY_INDEX). Without an index,'
+                    ' every file is post-processed.'),
+            make_option('--workers', default=1,
+                action='store', dest='workers', type='int',
+                help='The number of threads used to compare and transfer'
+                    ' files. Use more than one to overlap the network latency'
+                    ' of remote storages. Defaults to 1.'),
+            make_option('--prefetch', default=False,
+                action='store_true', dest='prefetch_listing',
+                help='List the destination storage once, before collecting,'
+                    ' and answer existence and modified_time checks from'
+                    ' that listing. File system storages are listed directly,'
+                    ' and other storages can define a bulk_listing method,'
+                    ' which should return (name, modified_time) pairs for'
+                    ' every file (the time may be None if it isn\'t known).'
+                    ' Any other storage is walked with listdir, which only'
+                    ' saves exists calls: modified times are still looked up'
+                    ' one file at a time.'),
+            make_option('--state-file', default=None,
+                action='store', dest='state_file', type='string',
+                help='A local file in which to record the size, modified time'
+                    ' and md5 hash of every source file after a successful'
+                    ' collect. Files that haven\'t changed since then are'
+                    ' skipped without touching the destination storage.'
+                    ' Defaults to ECSTATIC_COLLECT_STATE_FILE.'),
+            make_option('--gzip', default=False,
+                action='store_true', dest='gzip',
+                help='Save a gzipped copy (with a ".gz" suffix) of each'
+                    ' collected file, and of its post-processed copy, whose'
+                    ' extension is in ECSTATIC_GZIP_EXTENSIONS, unless the'
+                    ' destination already has an up-to-date one. Files smaller'
+                    ' than ECSTATIC_GZIP_MIN_SIZE, and files that gzip'
+                    ' doesn\'t make smaller, are skipped, and their existing'
+                    ' gzipped copies are deleted. With --workers, files are'
+                    ' compressed in that many processes.'),
+            make_option('--dedupe', default=False,
+                action='store_true', dest='dedupe',
+                help='Only collect the first of several files with identical'
+                    ' contents. The others should be served from the first'
+                    ' one\'s URL, which is what createstaticmanifest --dedupe'
+                    ' does. Files that reference other files (like CSS), and'
+                    ' the files they reference, are always collected.'),
+            make_option('--engine', default='default',
+                action='store', dest='engine', type='choice',
+                choices=['default', 'async'],
+                help='The engine used to compare and transfer files. The'
+                    ' async engine (which requires Python 3.5 or later) keeps'
+                    ' up to --concurrency files in flight on an event loop,'
+                    ' using the destination storage\'s async_exists,'
+                    ' async_modified_time, async_delete and async_save'
+                    ' methods if it has them, and calling its other methods'
+                    ' in a thread pool. It can\'t be used with --link.'),
+            make_option('--concurrency', default=100,
+                action='store', dest='concurrency', type='int',
+                help='The number of files the async engine transfers at'
+                    ' once. Defaults to 100.'),
+            make_option('--journal', default=None,
+                action='store', dest='journal', type='string',
+                help='A file in which to record each file as it\'s collected'
+                    ' and post-processed. It\'s removed once a run completes'
+                    ' without errors.'),
+            make_option('--resume', default=False,
+                action='store_true', dest='resume',
+                help='Skip the work that the --journal of an interrupted or'
+                    ' failed run records as done (for source files that'
+                    ' haven\'t changed since).'),
+            make_option('--retries', default=3,
+                action='store', dest='retries', type='int',
+                help='The number of times to retry collecting a file after an'
+                    ' I/O error (or one of the storage\'s transient_errors),'
+                    ' waiting twice as long before each attempt. Files that'
+                    ' still fail are reported once every other file has been'
+                    ' collected, unless 10 fail in a row, in which case the'
+                    ' collect is aborted. Other errors abort it right away.'
+                    ' Defaults to 3.'),
+            make_option('--stats-json', default=None,
+                action='store', dest='stats_json', type='string',
+                help='Write the time spent, files handled, bytes read and'
+                    ' written and storage calls made by each phase of the'
+                    ' collect to this file, as JSON. Storage calls are'
+                    ' counted as they are with --count-operations.'),
         ]
         super(CollectNewMixin, self).__init__(*args, **kwargs)
 
@@ -46,6 +162,17 @@ class CollectNewMixin(object):
 
         Split off from handle_noargs() to facilitate testing.
         """
+        if not self.stats_json:
+            return self._collect()
+
+        self.use_accounting_storage()
+        with self.stats.accounting():
+            result = self._collect()
+        with open(self.stats_json, 'w') as file:
+            json.dump(self.stats.as_dict(), file, indent=4)
+        return result
+
+    def _collect(self):
         if self.symlink:
             if sys.platform == 'win32':
                 raise CommandError("Symlinking is not supported by this "
@@ -56,36 +183,73 @@ class CollectNewMixin(object):
         if self.clear:
             self.clear_dir('')
 
+        self._source_md5s = {}
+        self._open_journal()
+        completed = False
+        try:
+            result = self._collect_found_files()
+            completed = True
+        finally:
+            self._close_journal(completed)
+        return result
+
+    def _collect_found_files(self):
+        with self.stats.phase('state'):
+            self._load_collect_state()
+        with self.stats.phase('listing'):
+            self._load_destination_listing()
+        with self.stats.phase('hash_index'):
+            self._load_hash_index()
+
         handler = self._get_handler()
 
         do_post_process = self.post_process and hasattr(self.storage, 'post_process')
 
-        found_files = SortedDict()
-        for finder in finders.get_finders():
-            for path, storage in finder.list(self.ignore_patterns):
-                # Prefix the relative path if the source storage contains it
-                if getattr(storage, 'prefix', None):
-                    prefixed_path = os.path.join(storage.prefix, path)
-                else:
-                    prefixed_path = path
-
-                if prefixed_path not in found_files:
-                    found_files[prefixed_path] = (storage, path)
-                    handler(path, prefixed_path, storage)
-                    if self.progressive_post_process and do_post_process:
-                        try:
-                            self._post_process(
-                                    {prefixed_path: (storage, path)},
-                                    self.dry_run)
-                        except ValueError as e:
-                            message = ('%s current storage requires all files'
-                                ' to have been collected first. Try '
-                                ' ecstatic.storage.CachedStaticFilesStorage' \
-                                % e)
-                            raise ValueError(message)
+        with self.stats.phase('scan'):
+            found_files = find_static_files(self.ignore_patterns)
+            self.stats.count(files=len(found_files))
+        if self.dedupe:
+            with self.stats.phase('dedupe'):
+                self.aliases = find_duplicates(found_files, self.storage,
+                                               self._get_source_md5)
+                for prefixed_path, canonical in self.aliases.items():
+                    del found_files[prefixed_path]
+                    self.log(u"Skipping '%s' (duplicate of '%s')"
+                             % (prefixed_path, canonical))
+                self.stats.count(files=len(self.aliases))
+
+        if self.engine == 'async':
+            get_async_collector(self, do_post_process).run(found_files)
+            concurrent = True
+        else:
+            concurrent = self._collect_files(handler, found_files,
+                                             do_post_process)
+
+        if concurrent:
+            # Files finish in an arbitrary order; restore the order in which
+            # they were found.
+            order = dict((prefixed_path, i) for i, prefixed_path in
+                         enumerate(found_files))
+            for files in (self.copied_files, self.symlinked_files,
+                          self.unmodified_files):
+                files.sort(key=lambda prefixed_path: order.get(prefixed_path,
+                                                               -1))
+
+        with self.stats.phase('hash_index'):
+            self._save_hash_index()
 
         if not self.progressive_post_process and do_post_process:
-            self._post_process(found_files, self.dry_run)
+            if self.incremental_post_process:
+                self._post_process_incrementally(found_files)
+            else:
+                self._post_process(found_files, self.dry_run)
+
+        if self.gzip:
+            with self.stats.phase('compress'):
+                self._compress_files(found_files, do_post_process)
+
+        with self.stats.phase('state'):
+            self._save_collect_state()
 
         return {
             'modified': self.copied_files + self.symlinked_files,
@@ -93,22 +257,200 @@ class CollectNewMixin(object):
             'post_processed': self.post_processed_files,
         }
 
+    def _collect_files(self, handler, found_files, do_post_process):
+        """
+        Collects the files, in worker threads if there's more than one worker.
+        Returns whether they were.
+
+        """
+        pool = None
+        pending = deque()
+        if self.workers > 1:
+            pool = ThreadPool(self.workers)
+
+        try:
+            for prefixed_path, (storage, path) in found_files.items():
+                if pool is None:
+                    self._collect_file(handler, path, prefixed_path, storage)
+                    self._file_collected(path, prefixed_path, storage,
+                                         do_post_process)
+                else:
+                    result = pool.apply_async(self._collect_file_buffered,
+                                              (handler, path, prefixed_path,
+                                               storage))
+                    pending.append((result, path, prefixed_path, storage))
+                    # Keep a bounded number of files in flight, and finish
+                    # them in the order they were found.
+                    if len(pending) >= self.workers * 2:
+                        self._finish_pending(pending.popleft(),
+                                             do_post_process)
+            while pending:
+                self._finish_pending(pending.popleft(), do_post_process)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return pool is not None
+
+    def _collect_file(self, handler, path, prefixed_path, source_storage):
+        with self.stats.phase('transfer'):
+            self.stats.count(files=1)
+            if self._skip_file(path, prefixed_path, source_storage):
+                return
+            attempt = 0
+            while True:
+                try:
+                    handler(path, prefixed_path, source_storage)
+                except self._get_transient_errors() as e:
+                    if attempt >= self.retries:
+                        self._file_failed(path, prefixed_path, e)
+                        return
+                    time.sleep(self._get_retry_delay(path, attempt, e))
+                    attempt += 1
+                else:
+                    break
+            self._file_done(path, prefixed_path, source_storage)
+
+    def _skip_file(self, path, prefixed_path, source_storage):
+        """
+        Returns True (having marked the file as unmodified) if the collect
+        state or the journal show that the file doesn't need to be collected.
+
+        """
+        if self._source_unchanged(path, prefixed_path, source_storage):
+            reason = 'not modified since the last collect'
+        elif self._get_journal_entry('transfer', path, prefixed_path,
+                                     source_storage) is not None:
+            self._record_source_state(path, prefixed_path, source_storage)
+            reason = 'already collected, according to the journal'
+        else:
+            return False
+        if prefixed_path not in self.unmodified_files:
+            self.unmodified_files.append(prefixed_path)
+        self.log(u"Skipping '%s' (%s)" % (path, reason))
+        return True
+
+    def _get_transient_errors(self):
+        return getattr(self.storage, 'transient_errors',
+                       self.transient_errors)
+
+    def _get_retry_delay(self, path, attempt, error):
+        delay = self.retry_delay * 2 ** attempt
+        self.log(u"Error collecting '%s' (%s). Retrying in %ss..."
+                 % (path, error, delay), level=1)
+        return delay
+
+    def _file_failed(self, path, prefixed_path, error):
+        with self._journal_lock:
+            self.failed_files.append((prefixed_path, error))
+            self.consecutive_failures += 1
+            abort = self.consecutive_failures == self.max_consecutive_failures
+        self.log(u"Failed to collect '%s': %s" % (path, error), level=1)
+        if abort:
+            raise CommandError('Aborting: the last %s files could not be'
+                               ' collected. The last error was: %s'
+                               % (self.max_consecutive_failures, error))
+
+    def _file_done(self, path, prefixed_path, source_storage):
+        with self._journal_lock:
+            self.consecutive_failures = 0
+        self._record_source_state(path, prefixed_path, source_storage)
+        self._write_journal('transfer', path, prefixed_path, source_storage)
+
+    def _collect_file_buffered(self, *args):
+        """
+        Runs ``_collect_file`` (in a worker thread), holding on to its log
+        messages instead of writing them immediately.
+
+        """
+        self._log_buffer.messages = []
+        try:
+            self._collect_file(*args)
+            return self._log_buffer.messages
+        finally:
+            self._log_buffer.messages = None
+
+    def _finish_pending(self, pending, do_post_process):
+        result, path, prefixed_path, source_storage = pending
+        for msg, level in result.get():
+            self.log(msg, level)
+        self._file_collected(path, prefixed_path, source_storage,
+                             do_post_process)
+
+    def _file_collected(self, path, prefixed_path, source_storage,
+                        do_post_process):
+        if self.progressive_post_process and do_post_process:
+            try:
+                self._post_process({prefixed_path: (source_storage, path)},
+                                   self.dry_run)
+            except ValueError as e:
+                message = ('%s current storage requires all files'
+                    ' to have been collected first. Try '
+                    ' ecstatic.storage.CachedStaticFilesStorage' \
+                    % e)
+                raise ValueError(message)
+
+    def handle_noargs(self, **options):
+        result = super(CollectNewMixin, self).handle_noargs(**options)
+        if self.failed_files:
+            raise CommandError(
+                '%s file(s) could not be collected:\n%s\nRun the command'
+                ' again (with --resume, if you used --journal) to retry them.'
+                % (len(self.failed_files), '\n'.join(
+                    u'  %s: %s' % (prefixed_path, error) for prefixed_path,
+                    error in self.failed_files)))
+        return result
+
+    def log(self, msg, level=2):
+        messages = getattr(self._log_buffer, 'messages', None)
+        if messages is not None:
+            messages.append((msg, level))
+        else:
+            super(CollectNewMixin, self).log(msg, level)
+
     def set_options(self, **options):
         super(CollectNewMixin, self).set_options(**options)
+        # Every file is checked against these lists (by collectstatic too), so
+        # make those checks constant-time.
+        for attr in ('copied_files', 'symlinked_files', 'unmodified_files',
+                     'post_processed_files'):
+            setattr(self, attr, PathList(getattr(self, attr)))
+        self.workers = max(options.get('workers') or 1, 1)
+        self.prefetch_listing = options.get('prefetch_listing', False)
+        self.state_file = options.get('state_file')
+        if not self.state_file:
+            self.state_file = settings.ECSTATIC_COLLECT_STATE_FILE
+        self.gzip = options.get('gzip', False)
+        self.dedupe = options.get('dedupe', False)
+        self.aliases = {}
+        self.engine = options.get('engine') or 'default'
+        self.concurrency = max(options.get('concurrency') or 100, 1)
+        if self.engine == 'async' and self.symlink:
+            raise CommandError("The async engine can't symlink files.")
+        self.journal_path = options.get('journal')
+        self.resume = options.get('resume', False)
+        if self.resume and not self.journal_path:
+            raise CommandError('--resume requires --journal.')
+        self.retries = max(options.get('retries') or 0, 0)
+        self.stats_json = options.get('stats_json')
+        self.stats = CollectStats()
+        self.processed_names = {}
         comparison_method = options.get('comparison_method')
         self.comparison_method = self.comparison_method_aliases.get(comparison_method, comparison_method)
         pp = options.get('pp')
-        if pp == 'default':
-            self.progressive_post_process = False
-        elif pp == 'progressive':
-            self.progressive_post_process = True
-        else:
-            raise CommandError("--pp must be 'default' or 'progressive'.")
+        if pp not in ('default', 'progressive', 'incremental'):
+            raise CommandError("--pp must be 'default', 'progressive' or"
+                               " 'incremental'.")
+        self.progressive_post_process = pp == 'progressive'
+        self.incremental_post_process = pp == 'incremental'
 
     def delete_file(self, path, prefixed_path, source_storage):
-        if self.comparison_method == 'modified_time':
-            return CollectStatic.delete_file(self, path, prefixed_path, source_storage)
-        elif self.storage.exists(prefixed_path):
+        with self.stats.phase('compare:%s' % self.comparison_method):
+            self.stats.count(files=1)
+            return self._delete_file(path, prefixed_path, source_storage)
+
+    def _delete_file(self, path, prefixed_path, source_storage):
+        if self._destination_exists(prefixed_path):
             should_delete = self.compare(path, prefixed_path, source_storage)
             if should_delete:
                 if self.dry_run:
@@ -117,6 +459,8 @@ class CollectNewMixin(object):
                     self.log(u"Deleting '%s'" % path)
                     self.storage.delete(prefixed_path)
             else:
+                if prefixed_path not in self.unmodified_files:
+                    self.unmodified_files.append(prefixed_path)
                 self.log(u"Skipping '%s' (not modified)" % path)
                 return False
         return True
@@ -144,33 +488,640 @@ class CollectNewMixin(object):
             return source_value == dest_value
         return comparitor
 
+    def compare_modified_time(self, path, prefixed_path, source_storage):
+        """
+        Mirrors the modified time check of Django's ``collectstatic``, but
+        gets the destination's modified time from the prefetched listing (with
+        ``--prefetch``).
+
+        """
+        try:
+            target_last_modified = self._get_destination_modified_time(
+                prefixed_path)
+            source_last_modified = source_storage.modified_time(path)
+        except (OSError, NotImplementedError, AttributeError):
+            return True
+        return self._is_modified(prefixed_path, target_last_modified,
+                                 source_last_modified)
+
+    def _is_modified(self, prefixed_path, target_last_modified,
+                     source_last_modified):
+        """
+        Returns True if the destination file needs to be replaced, given its
+        modified time and its source file's. Used by every engine, so that
+        they agree on which files have changed.
+
+        """
+        if self.local:
+            # Links have to be replaced by files and vice versa, even if they
+            # haven't been modified.
+            full_path = self.storage.path(prefixed_path)
+            if bool(self.symlink) != os.path.islink(full_path):
+                return True
+
+        # Avoid sub-second precision
+        target_last_modified = target_last_modified.replace(microsecond=0)
+        source_last_modified = source_last_modified.replace(microsecond=0)
+        return target_last_modified < source_last_modified
+
+    def _open_journal(self):
+        """
+        Loads the entries of the journal being resumed (if any) and opens the
+        journal for writing.
+
+        """
+        self.journal = {}
+        self.failed_files = []
+        self.consecutive_failures = 0
+        self._journal_lock = threading.Lock()
+        self._journal_file = None
+        if not self.journal_path:
+            return
+
+        storage_id = self.get_storage_id()
+        if self.resume and not self.clear:
+            try:
+                with open(self.journal_path) as file:
+                    lines = [json.loads(line) for line in file if line.strip()]
+            except (IOError, ValueError):
+                lines = []
+            if lines and lines[0].get('storage') == storage_id:
+                for entry in lines[1:]:
+                    self.journal[(entry['step'], entry['path'])] = entry
+
+        if self.dry_run:
+            return
+        if self.journal:
+            self._journal_file = open(self.journal_path, 'a')
+        else:
+            self._journal_file = open(self.journal_path, 'w')
+            self._journal_file.write('%s\n' % json.dumps({'storage': storage_id}))
+            self._journal_file.flush()
+
+    def _close_journal(self, completed):
+        if self._journal_file is None:
+            return
+        self._journal_file.close()
+        self._journal_file = None
+        if completed and not self.failed_files:
+            os.remove(self.journal_path)
+
+    def _get_journal_entry(self, step, path, prefixed_path, source_storage):
+        """
+        Returns the journal's entry for the step, if the source file hasn't
+        changed since it was written.
+
+        """
+        entry = self.journal.get((step, prefixed_path))
+        if entry is None:
+            return None
+        stat = self._stat_source(path, source_storage)
+        if entry.get('source') != (list(stat) if stat else None):
+            return None
+        return entry
+
+    def _write_journal(self, step, path, prefixed_path, source_storage,
+                       **data):
+        if self._journal_file is None:
+            return
+        stat = self._stat_source(path, source_storage)
+        data.update(step=step, path=prefixed_path,
+                    source=list(stat) if stat else None)
+        line = '%s\n' % json.dumps(data, sort_keys=True)
+        with self._journal_lock:
+            self._journal_file.write(line)
+            self._journal_file.flush()
+
+    def _load_collect_state(self):
+        """
+        Loads the state of the source files as of the last successful collect
+        to the same destination storage.
+
+        """
+        self.previous_state = {}
+        self.collect_state = {}
+        if not self.state_file or self.clear:
+            return
+        try:
+            with open(self.state_file) as file:
+                data = json.load(file)
+        except (IOError, ValueError):
+            return
+        if data.get('storage') == self.get_storage_id():
+            self.previous_state = data.get('files', {})
+
+    def _save_collect_state(self):
+        if not self.state_file or self.dry_run:
+            return
+        data = {'storage': self.get_storage_id(), 'files': self.collect_state}
+        with atomic_write(self.state_file, 'w') as file:
+            json.dump(data, file, sort_keys=True)
+
+    def _stat_source(self, path, source_storage):
+        try:
+            stat = os.stat(source_storage.path(path))
+        except (NotImplementedError, OSError):
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _source_unchanged(self, path, prefixed_path, source_storage):
+        """
+        Returns True if the source file is the same as it was at the end of
+        the last successful collect, in which case there's no need to look at
+        the destination at all.
+
+        """
+        previous = self.previous_state.get(prefixed_path)
+        if not previous:
+            return False
+        stat = self._stat_source(path, source_storage)
+        if stat is None or stat[0] != previous[0]:
+            return False
+        if stat[1] != previous[1]:
+            # The file has been touched. It's only unchanged if its contents
+            # are the same.
+            md5 = self._get_source_md5(source_storage, path, prefixed_path)
+            if md5 != previous[2]:
+                return False
+        self.collect_state[prefixed_path] = [stat[0], stat[1], previous[2]]
+        return True
+
+    def _record_source_state(self, path, prefixed_path, source_storage):
+        if not self.state_file:
+            return
+        stat = self._stat_source(path, source_storage)
+        if stat is not None:
+            md5 = self._get_source_md5(source_storage, path, prefixed_path)
+            self.collect_state[prefixed_path] = [stat[0], stat[1], md5]
+
+    def _load_destination_listing(self):
+        """
+        With ``--prefetch``, builds an in-memory index of the files in the
+        destination storage, mapping their names to their modified times (or
+        ``None``, if the time will have to be looked up). Storages that can't
+        be listed in bulk (see ``ecstatic.storage.get_bulk_listing``) are
+        walked with ``listdir``, which doesn't give modified times.
+
+        """
+        self.destination_listing = None
+        if not self.prefetch_listing:
+            return
+
+        listing = {}
+        if not self.clear:
+            bulk_listing = get_bulk_listing(self.storage)
+            if bulk_listing is not None:
+                listing.update(bulk_listing)
+            else:
+                try:
+                    self._walk_destination('', listing)
+                except OSError:
+                    # The destination doesn't exist yet. (Files missing from
+                    # the listing are simply collected.)
+                    pass
+        self.destination_listing = listing
+
+    def _walk_destination(self, path, listing):
+        dirs, files = self.storage.listdir(path)
+        for name in files:
+            listing[os.path.join(path, name) if path else name] = None
+        for name in dirs:
+            self._walk_destination(os.path.join(path, name) if path else name,
+                                   listing)
+
+    def _destination_exists(self, prefixed_path):
+        if self.destination_listing is not None:
+            return prefixed_path in self.destination_listing
+        return self.storage.exists(prefixed_path)
+
+    def _get_destination_modified_time(self, prefixed_path):
+        if self.destination_listing is None:
+            return self.storage.modified_time(prefixed_path)
+        modified_time = self.destination_listing.get(prefixed_path)
+        if modified_time is None:
+            modified_time = self.storage.modified_time(prefixed_path)
+            self.destination_listing[prefixed_path] = modified_time
+        return modified_time
+
     def compare_file_hash(self, path, prefixed_path, source_storage):
-        old_md5 = self._get_md5(self.storage, path)
-        new_md5 = self._get_md5(source_storage, prefixed_path)
+        old_md5 = self._get_storage_file_hash(self.storage, prefixed_path)
+        if old_md5 is None and self.hash_index is not None:
+            indexed = self.hash_index.get(prefixed_path)
+            if indexed is not None:
+                old_md5, old_size = indexed
+                if old_size is not None and old_size != source_storage.size(path):
+                    return True
+        if old_md5 is None:
+            old_md5 = self._read_md5(self.storage, prefixed_path)
+            if self.hash_index is not None:
+                self.hash_index[prefixed_path] = (old_md5, None)
+        new_md5 = self._get_source_md5(source_storage, path, prefixed_path)
         return old_md5 != new_md5
 
+    def _get_source_md5(self, source_storage, path, prefixed_path):
+        # Source hashes are remembered so that a copied file doesn't have to be
+        # hashed again to be recorded in the hash index.
+        md5 = self._source_md5s.get(prefixed_path)
+        if md5 is None:
+            md5 = self._get_md5(source_storage, path)
+            self._source_md5s[prefixed_path] = md5
+        return md5
+
+    def copy_file(self, path, prefixed_path, source_storage):
+        copied = prefixed_path in self.copied_files
+        super(CollectNewMixin, self).copy_file(path, prefixed_path,
+                                               source_storage)
+        if not copied and prefixed_path in self.copied_files:
+            self._file_copied(path, prefixed_path, source_storage)
+
+    def _file_copied(self, path, prefixed_path, source_storage):
+        try:
+            size = source_storage.size(path)
+        except (NotImplementedError, OSError):
+            pass
+        else:
+            self.stats.count(bytes_read=size,
+                             bytes_written=0 if self.dry_run else size,
+                             phase='transfer')
+        if self.hash_index is not None and not self.dry_run:
+            self.hash_index[prefixed_path] = (
+                self._get_source_md5(source_storage, path, prefixed_path),
+                source_storage.size(path))
+
+    def _get_index_file(self, path, suffix):
+        """
+        Returns the path of one of the local files in which indexes of the
+        destination are kept: the configured ``path`` or, if that's ``None``,
+        the collect state file's path with ``suffix`` appended. Indexes are
+        never kept in the destination storage itself, which is public.
+
+        """
+        if path is None and self.state_file:
+            return '%s.%s' % (self.state_file, suffix)
+        return path or None
+
+    def _load_hash_index(self):
+        """
+        Loads the index of the destination's file hashes, which is used (in
+        place of opening every destination file) by the file_hash comparison
+        method when the destination storage can't provide a file's hash
+        itself.
+
+        """
+        self.hash_index = None
+        self.hash_index_file = self._get_index_file(
+            settings.ECSTATIC_COLLECT_HASH_INDEX, 'hashes')
+        if self.comparison_method != 'file_hash' or not self.hash_index_file:
+            return
+
+        self.hash_index = {}
+        if self.clear:
+            return
+        try:
+            with open(self.hash_index_file) as file:
+                data = json.load(file)
+        except (IOError, ValueError):
+            return
+        if data.get('storage') == self.get_storage_id():
+            for prefixed_path, (md5, size) in data.get('files', {}).items():
+                self.hash_index[prefixed_path] = (md5, size)
+
+    def _save_hash_index(self):
+        if self.hash_index is None or self.dry_run:
+            return
+        files = dict((prefixed_path, list(value)) for prefixed_path, value
+                     in self.hash_index.items())
+        with atomic_write(self.hash_index_file, 'w') as file:
+            json.dump({'storage': self.get_storage_id(), 'files': files}, file,
+                      sort_keys=True)
+
     def _get_md5(self, storage, name):
+        md5 = self._get_storage_file_hash(storage, name)
+        if md5 is None:
+            md5 = self._read_md5(storage, name)
+        return md5
+
+    def _get_storage_file_hash(self, storage, name):
+        """
+        Returns the hash that the storage's ``file_hash`` method gives for the
+        named file, or ``None`` if the storage can't provide one. Note that
+        Django's ``CachedFilesMixin`` has a ``file_hash(name, content=None)``
+        method too, but it only hashes the content it's passed, returning
+        ``None`` without it.
+
+        """
         fn = getattr(storage, 'file_hash', None)
         if fn:
             return fn(name)
-        else:
-            file = storage.open(name)
-            contents = file.read()
-            return md5(contents).hexdigest()
+        return None
+
+    def _read_md5(self, storage, name):
+        # Storages' file_hash methods return md5 hexdigests, so that's what we
+        # have to use here too, regardless of ECSTATIC_HASH_ALGORITHM.
+        file = storage.open(name)
+        try:
+            return get_file_hash(file, 'md5')
+        finally:
+            file.close()
 
     def _post_process(self, found_files, dry_run):
+        with self.stats.phase('post_process'):
+            if self.journal or self.failed_files:
+                found_files = self._skip_post_processing(found_files)
+            self._do_post_process(found_files, dry_run)
+
+    def _skip_post_processing(self, found_files):
+        """
+        Leaves out the files that couldn't be collected, and those that the
+        journal shows were already post-processed (and haven't been collected
+        again since).
+
+        """
+        failed = set(prefixed_path for prefixed_path, error
+                     in self.failed_files)
+        remaining = SortedDict()
+        for prefixed_path, (source_storage, path) in found_files.items():
+            if prefixed_path in failed:
+                continue
+            entry = None
+            if prefixed_path not in self.copied_files:
+                entry = self._get_journal_entry('post_process', path,
+                                                prefixed_path, source_storage)
+            if entry is None:
+                remaining[prefixed_path] = (source_storage, path)
+                continue
+            self.log(u"Skipped post-processing '%s' (already done, according"
+                     u" to the journal)" % prefixed_path)
+            if entry.get('processed_path'):
+                self.processed_names[prefixed_path] = entry['processed_path']
+        return remaining
+
+    def _post_process_incrementally(self, found_files):
+        with self.stats.phase('dependency_index'):
+            self._load_dependency_index()
+        post_process_files = self._get_post_process_files(found_files)
+        self._post_process(post_process_files, self.dry_run)
+        with self.stats.phase('dependency_index'):
+            self._save_dependency_index(found_files, post_process_files)
+
+    def _load_dependency_index(self):
+        """
+        Loads the index that maps each file to the files that reference it, as
+        saved by the last incremental run. If there isn't one, every file will
+        be post-processed.
+
+        """
+        self.dependency_index = None
+        self.dependency_index_file = self._get_index_file(
+            settings.ECSTATIC_COLLECT_DEPENDENCY_INDEX, 'dependencies')
+        if not self.dependency_index_file or self.clear:
+            return
+        try:
+            with open(self.dependency_index_file) as file:
+                data = json.load(file)
+        except (IOError, ValueError):
+            return
+        if data.get('storage') == self.get_storage_id():
+            self.dependency_index = data.get('dependents', {})
+
+    def _get_post_process_files(self, found_files):
+        """
+        Returns the files that were collected in this run, along with the
+        files that reference them (and the files that reference those, and so
+        on).
+
+        """
+        if self.dependency_index is None:
+            return found_files
+        changed = set(self.copied_files + self.symlinked_files)
+        pending = list(changed)
+        while pending:
+            name = pending.pop().replace('\\', '/')
+            for dependent in self.dependency_index.get(name, ()):
+                if dependent not in changed:
+                    changed.add(dependent)
+                    pending.append(dependent)
+        return SortedDict((prefixed_path, value) for prefixed_path, value
+                          in found_files.items() if prefixed_path in changed)
+
+    def _save_dependency_index(self, found_files, post_processed_files):
+        if not self.dependency_index_file or self.dry_run:
+            return
+        failed = set(prefixed_path for prefixed_path, error
+                     in self.failed_files)
+        references = find_file_references(
+            SortedDict((prefixed_path, value) for prefixed_path, value
+                       in post_processed_files.items()
+                       if prefixed_path not in failed),
+            self.storage)
+
+        # Drop the entries of the files that were scanned again, and of those
+        # that no longer exist, then add the new ones.
+        dependents = {}
+        kept = set(found_files).difference(references)
+        for referenced, names in (self.dependency_index or {}).items():
+            names = [n for n in names if n in kept]
+            if names:
+                dependents[referenced] = names
+        for prefixed_path, referenced_names in references.items():
+            for referenced in referenced_names:
+                dependents.setdefault(referenced, []).append(prefixed_path)
+        for names in dependents.values():
+            names.sort()
+
+        with atomic_write(self.dependency_index_file, 'w') as file:
+            json.dump({'storage': self.get_storage_id(),
+                       'dependents': dependents}, file, sort_keys=True)
+        self.dependency_index = dependents
+
+    def _do_post_process(self, found_files, dry_run):
         processor = self.storage.post_process(found_files, dry_run=dry_run)
         for original_path, processed_path, processed in processor:
+            self.stats.count(files=1)
             if processed:
                 self.log(u"Post-processed '%s' as '%s" %
                          (original_path, processed_path), level=1)
                 self.post_processed_files.append(original_path)
+                self.processed_names[original_path] = processed_path
             else:
                 self.log(u"Skipped post-processing '%s'" % original_path)
+            if original_path in found_files:
+                source_storage, path = found_files[original_path]
+                self._write_journal('post_process', path, original_path,
+                                    source_storage,
+                                    processed_path=processed_path
+                                    if processed else None)
 
     def _get_handler(self):
         return self.link_file if self.symlink else self.copy_file
 
+    def _should_compress(self, prefixed_path, source_storage, path):
+        extension = os.path.splitext(prefixed_path)[1].lower()
+        if extension not in settings.ECSTATIC_GZIP_EXTENSIONS:
+            return False
+        try:
+            return source_storage.size(path) >= settings.ECSTATIC_GZIP_MIN_SIZE
+        except (NotImplementedError, OSError):
+            return True
+
+    def _compress_files(self, found_files, do_post_process):
+        """
+        Saves gzipped variants of the collected files (and of their
+        post-processed copies) that don't have an up-to-date one in the
+        destination yet, and records them in the manifest. The variants of
+        files that no longer qualify for compression are deleted.
+
+        """
+        # Work out what needs to be compressed, and where the content should
+        # be read from. Post-processed copies of files that reference other
+        # files differ from the originals, so those are read from the
+        # destination; everything else is read from the (local) source.
+        # Variants are made again for files that were copied during this run
+        # and for post-processed copies whose contents may have changed
+        # without their names changing (those that reference other files).
+        adjustable = list(getattr(self.storage, '_patterns', {}).keys())
+        failed = set(prefixed_path for prefixed_path, error
+                     in self.failed_files)
+        jobs = []
+        gzipped_names = set()
+        ineligible_names = []
+        served_names = {}
+
+        def add_job(prefixed_path, name, source, stale):
+            if stale or not self._destination_exists('%s.gz' % name):
+                jobs.append((prefixed_path, name, source))
+            else:
+                gzipped_names.add(name)
+
+        for prefixed_path, (source_storage, path) in found_files.items():
+            if prefixed_path in failed:
+                continue
+            processed_path = self._get_processed_name(prefixed_path,
+                                                      do_post_process)
+            served_names[prefixed_path] = processed_path or prefixed_path
+            if not self._should_compress(prefixed_path, source_storage, path):
+                ineligible_names.append(prefixed_path)
+                if processed_path and processed_path != prefixed_path:
+                    ineligible_names.append(processed_path)
+                continue
+            try:
+                source = {'path': source_storage.path(path)}
+            except NotImplementedError:
+                source = None
+            copied = prefixed_path in self.copied_files
+            add_job(prefixed_path, prefixed_path, source, copied)
+            if processed_path and processed_path != prefixed_path:
+                if matches_patterns(prefixed_path, adjustable):
+                    add_job(prefixed_path, processed_path, None,
+                            copied or prefixed_path in self.processed_names)
+                else:
+                    add_job(prefixed_path, processed_path, source, copied)
+
+        stale_names = [name for name in ineligible_names
+                       if self._destination_exists('%s.gz' % name)]
+
+        if self.dry_run:
+            for name in stale_names:
+                self.log(u"Pretending to delete '%s.gz'" % name, level=1)
+            for prefixed_path, name, source in jobs:
+                self.log(u"Pretending to compress '%s'" % name, level=1)
+            return
+
+        for name in stale_names:
+            self.storage.delete('%s.gz' % name)
+            self.log(u"Deleted '%s.gz' (no longer compressed)" % name,
+                     level=1)
+
+        def get_kwargs(name, source):
+            if source is not None:
+                return source
+            file = self.storage.open(name)
+            try:
+                return {'content': file.read()}
+            finally:
+                file.close()
+
+        if self.workers > 1:
+            pool = Pool(self.workers)
+            async_results = [pool.apply_async(compress_file,
+                                              kwds=get_kwargs(name, source))
+                             for prefixed_path, name, source in jobs]
+            results = (result.get() for result in async_results)
+        else:
+            pool = None
+            results = (compress_file(**get_kwargs(name, source))
+                       for prefixed_path, name, source in jobs)
+
+        try:
+            for (prefixed_path, name, source), compressed in zip(jobs, results):
+                gzip_name = '%s.gz' % name
+                if self._destination_exists(gzip_name):
+                    # Either it's about to be replaced, or it's out of date.
+                    self.storage.delete(gzip_name)
+                if compressed is None:
+                    self.log(u"Skipping compression of '%s' (no smaller)"
+                             % name)
+                    continue
+                self.storage.save(gzip_name, ContentFile(compressed))
+                self.stats.count(files=1, bytes_written=len(compressed))
+                self.log(u"Compressed '%s'" % name, level=1)
+                gzipped_names.add(name)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        with self.stats.phase('manifest'):
+            self._record_compressed_files(found_files, served_names,
+                                          gzipped_names)
+
+    def _get_processed_name(self, prefixed_path, do_post_process):
+        """
+        Returns the name of the file's post-processed copy, if it has one. For
+        files that weren't post-processed during this run, the storage is
+        asked (if it can tell).
+
+        """
+        processed_path = self.processed_names.get(prefixed_path)
+        if processed_path is None and do_post_process:
+            processed_path = get_stored_name(self.storage, prefixed_path)
+        return processed_path
+
+    def _record_compressed_files(self, found_files, served_names,
+                                 gzipped_names):
+        """
+        Adds a "<name>.gz" entry to the manifest for every file whose served
+        copy (the post-processed one, if there is one) has a gzipped variant,
+        so that ``StaticManifestMixin.gzip_url`` can find it, and removes the
+        entries of the other files. Files without a served name (those that
+        failed to collect) are left alone.
+
+        """
+        generate_url = getattr(self.storage, 'generate_url', None)
+        if generate_url is None or not settings.ECSTATIC_MANIFEST_FILE:
+            return
+
+        manifest = ConfiguredStaticFilesManifest()
+        # Manifests that predate ``remove`` can only gain entries.
+        remove = getattr(manifest, 'remove', None)
+        for prefixed_path, (source_storage, path) in found_files.items():
+            served_name = served_names.get(prefixed_path)
+            if served_name is None:
+                continue
+            if served_name in gzipped_names:
+                manifest.add('%s.gz' % path, get_gzip_url(generate_url(path)))
+            elif remove is not None:
+                remove('%s.gz' % path)
+        manifest.flush()
+
+
+def get_async_collector(command, do_post_process):
+    try:
+        from ..asyncengine import AsyncCollector
+    except SyntaxError:
+        raise CommandError('The async engine requires Python 3.5 or later.')
+    return AsyncCollector(command, do_post_process)
+
 
 class Command(StorageOverrideMixin, CollectNewMixin, CollectStatic):
     """
@@ -1,44 +1,164 @@
 from django.core.management.base import BaseCommand
 from django.db.models import get_models
 from django.db.models.fields.files import ImageField, FileField
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+import django
+import json
 import os
-from ...utils import get_hashed_filename
+from ...utils import atomic_write, copy_stored_file, get_hashed_filename
 
 
 class Command(BaseCommand):
+    """
+    Renames existing media files to include a hash of their contents.
+
+    Rows are read in batches of ``--batch-size``, in primary key order, and
+    only the file fields that changed are written back. With ``--checkpoint``,
+    the last primary key handled for each model is recorded after every batch,
+    so that an interrupted run can be resumed by running the command again
+    with the same checkpoint file. The file is removed once every model has
+    been handled.
+
+    """
     help = 'Renames existing media files to include a hash of their contents.'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', default=500,
+            action='store', dest='batch_size', type='int',
+            help='The number of rows read (and saved) at a time. Defaults to'
+                ' 500.'),
+        make_option('--workers', default=1,
+            action='store', dest='workers', type='int',
+            help='The number of threads used to hash and rename files.'
+                ' Defaults to 1.'),
+        make_option('--checkpoint', default=None,
+            action='store', dest='checkpoint', type='string',
+            help='A file in which to record progress, so that an'
+                ' interrupted run can be resumed.'),
+    )
+
     def handle(self, *args, **options):
-        for model in get_models():
-            # See if the model has any ImageFields or FileFields
-            # TODO: Add setting for field types
-            field_names = [f.name for f in model._meta.fields if type(f) in
-                    (ImageField, FileField)]
-
-            if field_names:
-                print('Hashing filenames for %s.%s...' % (model._meta.app_label,
-                                          model._meta.object_name))
-
-                for m in model.objects.all():
-                    updated = False
-                    for field_name in field_names:
-                        updated = updated or self.rename_file(m, field_name)
-                    if updated:
-                        m.save()
+        self.batch_size = options.get('batch_size') or 500
+        self.checkpoint_file = options.get('checkpoint')
+        self.checkpoint = self.load_checkpoint()
+
+        workers = options.get('workers') or 1
+        pool = ThreadPool(workers) if workers > 1 else None
+        try:
+            for model in get_models():
+                # See if the model has any ImageFields or FileFields
+                # TODO: Add setting for field types
+                field_names = [f.name for f in model._meta.fields if type(f)
+                               in (ImageField, FileField)]
+
+                if field_names:
+                    print('Hashing filenames for %s.%s...' % (
+                          model._meta.app_label, model._meta.object_name))
+                    self.hash_model(model, field_names, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def hash_model(self, model, field_names, pool=None):
+        label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        last_pk = self.checkpoint.get(label)
+        queryset = (model._default_manager.order_by('pk')
+                    .only(*field_names))
+        rename_files = partial(self.rename_files, field_names=field_names)
+
+        while True:
+            batch_queryset = queryset
+            if last_pk is not None:
+                batch_queryset = batch_queryset.filter(pk__gt=last_pk)
+            batch = list(batch_queryset[:self.batch_size])
+            if not batch:
+                break
+
+            if pool is not None:
+                results = pool.map(rename_files, batch)
+            else:
+                results = [rename_files(instance) for instance in batch]
+
+            for instance, renamed in zip(batch, results):
+                for field_name, old_name, new_name in renamed:
+                    print('    Renaming "%s" to "%s"' % (old_name, new_name))
+                if renamed:
+                    self.save_instance(model, instance,
+                                       [field_name for field_name, old_name,
+                                        new_name in renamed])
+
+            last_pk = batch[-1].pk
+            self.save_checkpoint(label, last_pk)
+
+    def rename_files(self, instance, field_names):
+        """
+        Renames the instance's files, returning a list of ``(field_name,
+        old_name, new_name)`` tuples for the ones that changed.
+
+        """
+        renamed = []
+        for field_name in field_names:
+            old_name = getattr(instance, field_name).name
+            if self.rename_file(instance, field_name):
+                renamed.append((field_name, old_name,
+                                getattr(instance, field_name).name))
+        return renamed
 
     def rename_file(self, instance, field_name):
         """
         Renames a file and updates the model field to point to the new file.
         Returns True if a change has been made; otherwise False
 
+        The file is copied within its storage if the storage allows it (see
+        ``ecstatic.utils.copy_stored_file``), and saved again otherwise.
+
         """
         file = getattr(instance, field_name)
 
         if file:
             new_name = get_hashed_filename(file.name, file)
             if new_name != file.name:
-                print('    Renaming "%s" to "%s"' % (file.name, new_name))
-                file.save(os.path.basename(new_name), file, save=False)
+                copied_name = copy_stored_file(file.storage, file.name,
+                                               new_name)
+                if copied_name is None:
+                    file.save(os.path.basename(new_name), file, save=False)
+                else:
+                    file.close()
+                    setattr(instance, field_name, copied_name)
                 return True
 
         return False
+
+    def save_instance(self, model, instance, field_names):
+        """
+        Writes only the provided file fields of the instance.
+
+        """
+        if django.VERSION >= (1, 5):
+            instance.save(update_fields=field_names)
+        else:
+            values = dict((field_name, getattr(instance, field_name).name)
+                          for field_name in field_names)
+            model._default_manager.filter(pk=instance.pk).update(**values)
+
+    def load_checkpoint(self):
+        if not self.checkpoint_file:
+            return {}
+        try:
+            with open(self.checkpoint_file) as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def save_checkpoint(self, label, last_pk):
+        if not self.checkpoint_file:
+            return
+        self.checkpoint[label] = last_pk
+        with atomic_write(self.checkpoint_file, 'w') as file:
+            json.dump(self.checkpoint, file, sort_keys=True)
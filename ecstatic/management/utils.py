@@ -1,6 +1,14 @@
+from django.conf import settings
+from django.contrib.staticfiles import finders
 from django.contrib.staticfiles.storage import staticfiles_storage
+from django.contrib.staticfiles.utils import matches_patterns
 from django.core.files.storage import get_storage_class
+from django.utils.datastructures import SortedDict
 from optparse import make_option
+import os
+from ..accounting import accounting
+from ..storage import OperationAccountingMixin, get_accounting_storage_class
+from ..utils import find_referenced_names
 
 
 class StorageOverrideMixin(object):
@@ -9,9 +17,23 @@ class StorageOverrideMixin(object):
             make_option('-s', '--storage', action='store',
                 dest='storage_override', type="string",
                 help='override default storage backend'),
+            make_option('--count-operations', action='store_true',
+                dest='count_operations', default=False,
+                help='Count and time the operations made on the storage, and'
+                    ' report them when the command finishes. Storages that'
+                    ' extend OperationAccountingMixin are always reported.'),
         )
         super(StorageOverrideMixin, self).__init__(*args, **kwargs)
 
+    def execute(self, *args, **options):
+        with accounting() as operation_log:
+            result = super(StorageOverrideMixin, self).execute(*args,
+                                                               **options)
+        verbosity = int(options.get('verbosity', 1))
+        if getattr(self, 'report_operations', False) and verbosity >= 1:
+            self.stdout.write('Storage operations: %s\n' % operation_log)
+        return result
+
     def set_options(self, **options):
         try:
             super_set_options = super(StorageOverrideMixin, self).set_options
@@ -26,6 +48,13 @@ class StorageOverrideMixin(object):
             self.storage = cls()
         else:
             self.storage = staticfiles_storage
+        self.storage_path = storage_override or settings.STATICFILES_STORAGE
+
+        self.report_operations = bool(options.get('count_operations'))
+        if isinstance(self.storage, OperationAccountingMixin):
+            self.report_operations = True
+        if options.get('count_operations'):
+            self.use_accounting_storage()
 
         try:
             self.storage.path('')
@@ -33,3 +62,140 @@ class StorageOverrideMixin(object):
             self.local = False
         else:
             self.local = True
+
+    def use_accounting_storage(self):
+        """
+        Replaces the storage with one that counts its operations (see
+        ``ecstatic.accounting``), unless it already does.
+
+        """
+        if not isinstance(self.storage, OperationAccountingMixin):
+            cls = get_storage_class(self.storage_path)
+            self.storage = get_accounting_storage_class(cls)()
+
+    def get_storage_id(self):
+        """
+        Returns a string identifying the storage being used, so that state
+        recorded for one storage isn't mistakenly used for another.
+
+        """
+        return '%s %s' % (self.storage_path,
+                          getattr(self.storage, 'base_url', None))
+
+
+class PathList(list):
+    """
+    A list of paths that also keeps them in a set, so that checking whether a
+    path is in it (which ``collectstatic`` does for every file it handles)
+    doesn't mean scanning the whole list. Only ``append`` and ``extend`` are
+    supported for adding paths.
+
+    """
+    def __init__(self, paths=()):
+        super(PathList, self).__init__(paths)
+        self._paths = set(self)
+
+    def append(self, path):
+        super(PathList, self).append(path)
+        self._paths.add(path)
+
+    def extend(self, paths):
+        paths = list(paths)
+        super(PathList, self).extend(paths)
+        self._paths.update(paths)
+
+    def __contains__(self, path):
+        return path in self._paths
+
+
+def find_static_files(ignore_patterns):
+    """
+    Returns a ``SortedDict`` mapping the (prefixed) path of every file found by
+    the staticfiles finders to a ``(storage, path)`` tuple. As with
+    ``collectstatic``, the first file found for a path wins.
+
+    """
+    found_files = SortedDict()
+    for finder in finders.get_finders():
+        for path, storage in finder.list(ignore_patterns):
+            # Prefix the relative path if the source storage contains it
+            if getattr(storage, 'prefix', None):
+                prefixed_path = os.path.join(storage.prefix, path)
+            else:
+                prefixed_path = path
+
+            if prefixed_path not in found_files:
+                found_files[prefixed_path] = (storage, path)
+    return found_files
+
+
+def find_file_references(found_files, storage):
+    """
+    Returns a dict mapping the prefixed path of each found file that can
+    reference other files (because it matches one of ``storage``'s
+    post-processing patterns) to the set of (prefixed) paths it references.
+
+    """
+    patterns = getattr(storage, '_patterns', {})
+    references = {}
+    for prefixed_path, (source_storage, path) in found_files.items():
+        for extension, extension_patterns in patterns.items():
+            if not matches_patterns(prefixed_path, (extension,)):
+                continue
+            file = source_storage.open(path)
+            try:
+                content = file.read().decode('utf-8', 'replace')
+            finally:
+                file.close()
+            references.setdefault(prefixed_path, set()).update(
+                find_referenced_names(prefixed_path, content,
+                    [pattern for pattern, template in extension_patterns]))
+    return references
+
+
+def get_stored_name(storage, name):
+    """
+    Returns the name under which ``storage`` keeps the copy of the file that
+    it serves (the post-processed one, for storages that can tell), or the
+    name itself.
+
+    """
+    stored_name = getattr(storage, 'stored_name', None)
+    if stored_name is not None:
+        try:
+            return stored_name(name)
+        except ValueError:
+            pass
+    return name
+
+
+def find_duplicates(found_files, storage, get_hash):
+    """
+    Returns a dict mapping the prefixed path of each found file whose contents
+    are identical to an earlier file's to the prefixed path of that earlier
+    file. ``get_hash`` is called with a file's source storage, path and
+    prefixed path and should return a digest of its contents.
+
+    Files that can reference other files (those matching ``storage``'s
+    post-processing patterns) and the files they reference are never treated
+    as duplicates: references are rewritten relative to the referencing file,
+    so they have to stay where they are.
+
+    """
+    patterns = list(getattr(storage, '_patterns', {}).keys())
+    referenced = set()
+    for names in find_file_references(found_files, storage).values():
+        referenced.update(names)
+
+    canonical_paths = {}
+    aliases = {}
+    for prefixed_path, (source_storage, path) in found_files.items():
+        if prefixed_path.replace('\\', '/') in referenced:
+            continue
+        if matches_patterns(prefixed_path, patterns):
+            continue
+        digest = get_hash(source_storage, path, prefixed_path)
+        canonical = canonical_paths.setdefault(digest, prefixed_path)
+        if canonical != prefixed_path:
+            aliases[prefixed_path] = canonical
+    return aliases
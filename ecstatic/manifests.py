@@ -7,69 +7,508 @@ else:
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.functional import LazyObject
 from importlib import import_module
+import hashlib
+import mmap
 import os
 import json
+import re
+import sqlite3
+import struct
+import threading
+import time
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+from .utils import atomic_write
 
 
 class NotInManifest(Exception):
     pass
 
 
-class JsonManifest(object):
+class BaseManifest(object):
     _cleared = False
-    _data = {}
+    _stat_checked = None
+
+    def __init__(self):
+        self._data = {}
+        self._removed = set()
 
     def clear(self):
         self._cleared = True
         self._data = {}
+        self._removed = set()
 
     def add(self, key, value):
         self._data[key] = value
+        self._removed.discard(key)
 
-    def flush(self):
-        file = open(settings.ECSTATIC_MANIFEST_FILE, mode='w+')
-        data = {}
+    def remove(self, key):
+        """
+        Removes the entry for the provided name (if there is one) when the
+        manifest is flushed.
+
+        """
+        self._data.pop(key, None)
+        self._removed.add(key)
+
+    def _merge(self):
+        """
+        Returns the entries of the manifest file, with the pending changes
+        applied.
+
+        """
+        data = {} if self._cleared else self.load()
+        data.update(self._data)
+        for key in self._removed:
+            data.pop(key, None)
+        return data
+
+    def _stat_manifest(self):
+        """
+        Returns the result of ``os.stat`` for the manifest file. The file is
+        stat'ed at most once every ``ECSTATIC_MANIFEST_CHECK_INTERVAL``
+        seconds; in between, the last known value is reused.
+
+        """
+        now = time.time()
+        interval = settings.ECSTATIC_MANIFEST_CHECK_INTERVAL
+        checked = self._stat_checked
+        if checked is None or not interval or now - checked[1] >= interval:
+            checked = (os.stat(settings.ECSTATIC_MANIFEST_FILE), now)
+            self._stat_checked = checked
+        return checked[0]
+
+    def load(self):
+        """
+        Returns all of the entries in the manifest file, or an empty dict if
+        there isn't one yet.
 
-        if not self._cleared:
-            # Load the existing data from the file
-            is_empty = file.read(1) is None
-            file.seek(0)
-            if not is_empty:
-                data = json.load(file)
-
-        self._data.update(data)
-        json.dump(self._data, file, indent=4)
-        file.truncate()
-        file.close()
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """
+        Returns a dict mapping each of the provided names to its URL.
+
+        """
+        return dict((key, self.get(key)) for key in keys)
+
+
+class JsonManifest(BaseManifest):
+    """
+    A manifest stored as a JSON file. Along with the entries themselves, the
+    file contains a generation id (a hash of the entries), which is used to
+    namespace the cached entries so that they're only reloaded when the
+    manifest actually changes. The generation is written on the first line of
+    the file, so that it can be checked without parsing the entries.
+
+    """
+    _state = None
+    _generation_re = re.compile(br'^\{"generation": "([0-9a-f]+)",$')
+
+    def flush(self):
+        data = self._merge()
+        generation = hashlib.sha1(json.dumps(data, sort_keys=True)
+                                  .encode('utf-8')).hexdigest()
+        # Write to a temporary file and move it into place so that readers
+        # never see a partially written manifest.
+        with atomic_write(settings.ECSTATIC_MANIFEST_FILE, 'w') as file:
+            file.write('{"generation": %s,\n "files": %s}\n' % (
+                json.dumps(generation),
+                json.dumps(data, indent=4, sort_keys=True)))
         self._data = {}
+        self._removed = set()
         self._cleared = False
 
-    def _get_cache_key(self, name, manifest_mtime):
-        return 'ecstatic:staticmanifest:%s:%s' % (manifest_mtime, name)
+    def load(self):
+        if not os.path.exists(settings.ECSTATIC_MANIFEST_FILE):
+            return {}
+        return self._read()[1]
 
-    def get(self, key):
-        manifest_mtime = os.path.getmtime(settings.ECSTATIC_MANIFEST_FILE)
-        cache_key = self._get_cache_key(key, manifest_mtime)
+    def _read(self):
+        """
+        Reads the manifest file, returning its generation and its entries.
+
+        """
+        with open(settings.ECSTATIC_MANIFEST_FILE, 'rb') as file:
+            contents = file.read()
+        data = json.loads(contents.decode('utf-8'))
+        if isinstance(data.get('files'), dict) and 'generation' in data:
+            return data['generation'], data['files']
+        # A manifest written by an older version of Ecstatic, which is just a
+        # dict of entries.
+        return hashlib.sha1(contents).hexdigest(), data
+
+    def _read_generation(self):
+        """
+        Reads the generation of the manifest file from its first line, without
+        parsing the entries.
+
+        """
+        with open(settings.ECSTATIC_MANIFEST_FILE, 'rb') as file:
+            line = file.readline()
+            match = self._generation_re.match(line.rstrip())
+            if match:
+                return match.group(1).decode('ascii')
+            # The generation of a manifest without the header is the hash of
+            # its contents (see ``_read``).
+            generation = hashlib.sha1(line)
+            for chunk in iter(lambda: file.read(65536), b''):
+                generation.update(chunk)
+            return generation.hexdigest()
+
+    def _get_state(self):
+        """
+        Returns the signature and generation of the manifest file, along with
+        the in-process copy of its entries, if there is one (or ``None``). The
+        generation is only read again once the file has been replaced.
+
+        """
+        stat = self._stat_manifest()
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        state = self._state
+        if state is None or state[0] != signature:
+            generation = self._read_generation()
+            if state is not None and state[1] == generation:
+                # The file was rewritten with the same contents.
+                data = state[2]
+            else:
+                data = None
+            state = (signature, generation, data)
+            self._state = state
+        return state
+
+    def _get_entries(self):
+        """
+        Returns the generation of the manifest file and an in-process copy of
+        its entries, parsing the file if there's no copy yet. The entries are
+        never mutated, so they can safely be shared between threads.
+
+        With ``ECSTATIC_MANIFEST_SNAPSHOT``, every lookup is answered from the
+        copy. Otherwise, lookups go through the cache, and the copy is only
+        needed to fill it (or while another process is filling it).
+
+        """
+        signature, generation, data = self._get_state()
+        if data is None:
+            read_generation, data = self._read()
+            if read_generation != generation:
+                # The file was replaced since it was stat'ed; it'll be
+                # stat'ed again on the next lookup.
+                signature, generation = None, read_generation
+            self._state = (signature, generation, data)
+        return generation, data
+
+    def _release_entries(self):
+        """
+        Drops the in-process copy of the entries once the cache can answer
+        every lookup.
+
+        """
+        state = self._state
+        if state is not None and state[2] is not None:
+            self._state = (state[0], state[1], None)
+
+    def _get_cache_key(self, name, generation):
+        return 'ecstatic:staticmanifest:%s:%s' % (generation, name)
+
+    def _get_cache(self):
         if django.VERSION < (1, 7):
-            cache = get_cache(settings.ECSTATIC_MANIFEST_CACHE)
+            return get_cache(settings.ECSTATIC_MANIFEST_CACHE)
         else:
-            cache = caches[settings.ECSTATIC_MANIFEST_CACHE]
-        value = cache.get(cache_key)
-        if value is None:
-            # Populate the cache with the entire contents of the manifest.
-            # The manifest should fit in the cache, so this will reduce the
-            # number of times we need to read the file.
-            file = open(settings.ECSTATIC_MANIFEST_FILE)
-            data = json.load(file)
-            for name, url in data.items():
-                cache.set(self._get_cache_key(name, manifest_mtime), url)
-                if name == key:
-                    value = url
+            return caches[settings.ECSTATIC_MANIFEST_CACHE]
+
+    def _get_lock_key(self, generation):
+        return 'ecstatic:staticmanifestlock:%s' % generation
+
+    def _get_filled_key(self, generation):
+        return 'ecstatic:staticmanifestfilled:%s' % generation
+
+    def _is_filled(self, cache, generation):
+        return bool(cache.get(self._get_filled_key(generation)))
+
+    def _populate_cache(self, cache, data, generation):
+        # Populate the cache with the entire contents of the manifest. The
+        # manifest should fit in the cache, so this will reduce the number of
+        # times we need to read the file. Only the process that acquires the
+        # lock for this version of the manifest does the writing; everybody
+        # else just uses their copy of the entries. The lock is left to
+        # expire on its own so that the cache isn't refilled for every miss.
+        lock_key = self._get_lock_key(generation)
+        if not cache.add(lock_key, True,
+                         settings.ECSTATIC_MANIFEST_FILL_LOCK_TIMEOUT):
+            return
+        start = time.time()
+        items = list(data.items())
+        chunk_size = settings.ECSTATIC_MANIFEST_CACHE_CHUNK_SIZE
+        for i in range(0, len(items), chunk_size):
+            cache.set_many(dict((self._get_cache_key(name, generation), url)
+                                for name, url in items[i:i + chunk_size]))
+
+        # Once every entry is in the cache, a name that isn't there isn't in
+        # the manifest either. The marker that says so expires before the
+        # first entries written do.
+        timeout = getattr(cache, 'default_timeout', None)
+        if timeout is not None:
+            timeout = int(timeout - (time.time() - start)) - 1
+            if timeout <= 0:
+                return
+        cache.set(self._get_filled_key(generation), True, timeout)
+
+    def get(self, key):
+        if settings.ECSTATIC_MANIFEST_SNAPSHOT:
+            value = self._get_entries()[1].get(key)
+        else:
+            generation = self._get_state()[1]
+            cache = self._get_cache()
+            value = cache.get(self._get_cache_key(key, generation))
+            if value is None and not self._is_filled(cache, generation):
+                generation, data = self._get_entries()
+                self._populate_cache(cache, data, generation)
+                value = data.get(key)
+            else:
+                self._release_entries()
         if value is None:
             raise NotInManifest('The file "%s" was not found in the'
                                 ' manifest.' % key)
         return value
 
+    def get_many(self, keys):
+        """
+        Returns a dict mapping each of the provided names to its URL. All of
+        the names are looked up in the cache at once. Until the cache has been
+        populated, any misses are filled from the in-process copy of the
+        manifest.
+
+        """
+        keys = list(keys)
+        if settings.ECSTATIC_MANIFEST_SNAPSHOT:
+            data = self._get_entries()[1]
+            values = dict((key, data[key]) for key in keys if key in data)
+        else:
+            generation = self._get_state()[1]
+            cache = self._get_cache()
+            cache_keys = dict((self._get_cache_key(key, generation), key)
+                              for key in keys)
+            filled_key = self._get_filled_key(generation)
+            found = cache.get_many(list(cache_keys) + [filled_key])
+            filled = found.pop(filled_key, None)
+            values = dict((cache_keys[cache_key], value) for cache_key, value
+                          in found.items())
+            if len(values) == len(cache_keys) or filled:
+                self._release_entries()
+            else:
+                generation, data = self._get_entries()
+                self._populate_cache(cache, data, generation)
+                for key in keys:
+                    if key not in values and key in data:
+                        values[key] = data[key]
+        missing = [key for key in keys if key not in values]
+        if missing:
+            raise NotInManifest('The files %s were not found in the'
+                                ' manifest.' % ', '.join('"%s"' % key for key
+                                                         in missing))
+        return values
+
+
+class BinaryManifest(BaseManifest):
+    """
+    A manifest stored as a sorted binary table. Lookups are binary searches
+    over a memory-mapped view of the file, so nothing is parsed up front and
+    the pages are shared by every process that has the manifest open.
+
+    The file starts with a header (magic, format version, entry count),
+    followed by one ``(key offset, key length, value offset, value length)``
+    record per entry, sorted by key, followed by the UTF-8 encoded keys and
+    values themselves.
+
+    """
+    magic = b'ECSM'
+    version = 1
+    header = struct.Struct('<4sII')
+    record = struct.Struct('<IIII')
+    _mapping = None
+
+    def flush(self):
+        data = self._merge()
+
+        entries = sorted((key.encode('utf-8'), value.encode('utf-8'))
+                         for key, value in data.items())
+        offset = self.header.size + self.record.size * len(entries)
+        records = []
+        for key, value in entries:
+            records.append(self.record.pack(offset, len(key),
+                                            offset + len(key), len(value)))
+            offset += len(key) + len(value)
+
+        with atomic_write(settings.ECSTATIC_MANIFEST_FILE) as file:
+            file.write(self.header.pack(self.magic, self.version,
+                                        len(entries)))
+            file.write(b''.join(records))
+            for key, value in entries:
+                file.write(key)
+                file.write(value)
+
+        self._data = {}
+        self._removed = set()
+        self._cleared = False
+
+    def _open(self):
+        with open(settings.ECSTATIC_MANIFEST_FILE, 'rb') as file:
+            buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = self.header.unpack_from(buf, 0)
+        if magic != self.magic or version != self.version:
+            raise ValueError('"%s" is not a binary staticfiles manifest.'
+                             % settings.ECSTATIC_MANIFEST_FILE)
+        return buf, count
+
+    def _get_mapping(self):
+        """
+        Returns the memory-mapped manifest, remapping it if the file has been
+        replaced since it was last opened.
+
+        """
+        stat = self._stat_manifest()
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        mapping = self._mapping
+        if mapping is None or mapping[0] != signature:
+            mapping = (signature,) + self._open()
+            self._mapping = mapping
+        return mapping[1:]
+
+    def _read_record(self, buf, index):
+        offset = self.header.size + self.record.size * index
+        return self.record.unpack_from(buf, offset)
+
+    def load(self):
+        if not os.path.exists(settings.ECSTATIC_MANIFEST_FILE):
+            return {}
+        buf, count = self._open()
+        data = {}
+        for i in range(count):
+            key_offset, key_length, value_offset, value_length = \
+                self._read_record(buf, i)
+            key = buf[key_offset:key_offset + key_length].decode('utf-8')
+            value = buf[value_offset:value_offset + value_length]
+            data[key] = value.decode('utf-8')
+        buf.close()
+        return data
+
+    def get(self, key):
+        buf, count = self._get_mapping()
+        needle = key.encode('utf-8')
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_offset, key_length, value_offset, value_length = \
+                self._read_record(buf, mid)
+            candidate = buf[key_offset:key_offset + key_length]
+            if candidate < needle:
+                lo = mid + 1
+            elif candidate > needle:
+                hi = mid
+            else:
+                value = buf[value_offset:value_offset + value_length]
+                return value.decode('utf-8')
+        raise NotInManifest('The file "%s" was not found in the'
+                            ' manifest.' % key)
+
+
+class SqliteManifest(BaseManifest):
+    """
+    A manifest stored in an indexed SQLite table. Entries are written in a
+    single transaction and looked up with point queries, so the manifest never
+    has to be loaded in its entirety. Well suited for very large static trees.
+
+    """
+    table = 'ecstatic_manifest'
+    query_chunk_size = 500
+
+    def flush(self):
+        connection = sqlite3.connect(settings.ECSTATIC_MANIFEST_FILE)
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS %s (name TEXT'
+                                   ' PRIMARY KEY, url TEXT NOT NULL)'
+                                   % self.table)
+                if self._cleared:
+                    connection.execute('DELETE FROM %s' % self.table)
+                connection.executemany('DELETE FROM %s WHERE name = ?'
+                                       % self.table,
+                                       [(key,) for key in self._removed])
+                connection.executemany('INSERT OR REPLACE INTO %s (name, url)'
+                                       ' VALUES (?, ?)' % self.table,
+                                       list(self._data.items()))
+        finally:
+            connection.close()
+        self._data = {}
+        self._removed = set()
+        self._cleared = False
+
+    def load(self):
+        if not os.path.exists(settings.ECSTATIC_MANIFEST_FILE):
+            return {}
+        connection = sqlite3.connect(settings.ECSTATIC_MANIFEST_FILE)
+        try:
+            return dict(connection.execute('SELECT name, url FROM %s'
+                                           % self.table))
+        except sqlite3.OperationalError:
+            # The table hasn't been created yet.
+            return {}
+        finally:
+            connection.close()
+
+    def _connect(self):
+        path = os.path.abspath(settings.ECSTATIC_MANIFEST_FILE)
+        try:
+            return sqlite3.connect('file:%s?mode=ro&cache=shared'
+                                   % quote(path), uri=True)
+        except TypeError:
+            # The ``uri`` argument isn't supported before Python 3.4.
+            return sqlite3.connect(path)
+
+    def _get_connection(self):
+        """
+        Returns a read-only connection for the current thread, reconnecting if
+        the manifest file has been replaced since it was opened.
+
+        """
+        local = self.__dict__.setdefault('_local', threading.local())
+        inode = self._stat_manifest().st_ino
+        connection = getattr(local, 'connection', None)
+        if connection is None or connection[0] != inode:
+            if connection is not None:
+                connection[1].close()
+            connection = (inode, self._connect())
+            local.connection = connection
+        return connection[1]
+
+    def get(self, key):
+        row = self._get_connection().execute(
+            'SELECT url FROM %s WHERE name = ?' % self.table, (key,)).fetchone()
+        if row is None:
+            raise NotInManifest('The file "%s" was not found in the'
+                                ' manifest.' % key)
+        return row[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        connection = self._get_connection()
+        values = {}
+        for i in range(0, len(keys), self.query_chunk_size):
+            chunk = keys[i:i + self.query_chunk_size]
+            values.update(connection.execute(
+                'SELECT name, url FROM %s WHERE name IN (%s)'
+                % (self.table, ', '.join('?' * len(chunk))), chunk))
+        missing = [key for key in keys if key not in values]
+        if missing:
+            raise NotInManifest('The files %s were not found in the'
+                                ' manifest.' % ', '.join('"%s"' % key for key
+                                                         in missing))
+        return values
+
 
 class ConfiguredStaticFilesManifest(LazyObject):
     def _setup(self):
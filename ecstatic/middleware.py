@@ -0,0 +1,30 @@
+from django.conf import settings
+import logging
+from .accounting import start_accounting, stop_accounting
+
+
+logger = logging.getLogger('ecstatic.accounting')
+
+
+class OperationAccountingMiddleware(object):
+    """
+    Counts the operations made by accounting storages (see
+    ``ecstatic.storage.OperationAccountingMixin``) while handling each request.
+    The totals are logged to the ``ecstatic.accounting`` logger and, when
+    ``DEBUG`` is on, added to the response as an ``X-Storage-Operations``
+    header.
+
+    """
+    def process_request(self, request):
+        request._storage_operation_log = start_accounting(thread_only=True)
+
+    def process_response(self, request, response):
+        operation_log = getattr(request, '_storage_operation_log', None)
+        if operation_log is None:
+            return response
+        stop_accounting(operation_log)
+        logger.debug('Storage operations for %s: %s', request.path,
+                     operation_log)
+        if settings.DEBUG:
+            response['X-Storage-Operations'] = str(operation_log)
+        return response
@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+from django.utils.datastructures import SortedDict
+import threading
+import time
+from .accounting import OperationLog, start_accounting, stop_accounting
+
+
+class PhaseStats(object):
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.operations = OperationLog()
+
+    def as_dict(self):
+        return {
+            'seconds': round(self.seconds, 6),
+            'files': self.files,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'storage_calls': dict((operation, count) for operation,
+                                  (count, total)
+                                  in self.operations.operations.items()),
+        }
+
+
+class CollectStats(object):
+    """
+    Records the time spent, files handled, bytes read and written and storage
+    calls made in each phase of a collect. Phases may be nested (comparisons
+    happen during transfers, for example); the time spent in a nested phase is
+    only counted towards that phase. With several worker threads, times are
+    summed over all of them.
+
+    Storage calls are only recorded for storages that extend
+    ``ecstatic.storage.OperationAccountingMixin``, inside ``accounting()``.
+    Each phase gets an ``OperationLog`` (see ``ecstatic.accounting``) for the
+    thread that's in it; calls made outside of any phase are counted towards
+    "other".
+
+    """
+    def __init__(self):
+        self.phases = SortedDict()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._operation_log = None
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def get_phase(self, name):
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = PhaseStats()
+            return phase
+
+    @contextmanager
+    def accounting(self):
+        """
+        Records the storage operations made (by any thread) until the block
+        exits.
+
+        """
+        self._operation_log = start_accounting()
+        try:
+            yield
+        finally:
+            stop_accounting(self._operation_log)
+
+    def _start_operation_log(self, frame):
+        if self._operation_log is not None:
+            frame[2] = start_accounting(thread_only=True)
+
+    def _stop_operation_log(self, frame):
+        if frame[2] is not None:
+            stop_accounting(frame[2])
+            self.get_phase(frame[0]).operations.update(frame[2])
+            frame[2] = None
+
+    @contextmanager
+    def phase(self, name):
+        phase = self.get_phase(name)
+        stack = self._get_stack()
+        if stack:
+            # Operations are only counted towards the innermost phase.
+            self._stop_operation_log(stack[-1])
+        # Each frame holds the phase name, the time spent in nested phases and
+        # the log of the phase's storage operations.
+        frame = [name, 0.0, None]
+        self._start_operation_log(frame)
+        stack.append(frame)
+        start = time.time()
+        try:
+            yield phase
+        finally:
+            elapsed = time.time() - start
+            stack.pop()
+            self._stop_operation_log(frame)
+            if stack:
+                stack[-1][1] += elapsed
+                self._start_operation_log(stack[-1])
+            with self._lock:
+                phase.seconds += elapsed - frame[1]
+
+    def record_operation(self, phase, operation, seconds):
+        """
+        Counts a storage operation, and the time it took, towards the named
+        phase. This is for operations that ``phase()`` can't see because they
+        aren't made by a thread that's in the phase (like the coroutines
+        awaited by the async engine).
+
+        """
+        stats = self.get_phase(phase)
+        with self._lock:
+            stats.seconds += seconds
+        if self._operation_log is not None:
+            stats.operations.record(operation, seconds)
+
+    def count(self, files=0, bytes_read=0, bytes_written=0, phase=None):
+        """
+        Adds to the counters of the named phase (or of the current thread's
+        innermost phase).
+
+        """
+        if phase is None:
+            stack = self._get_stack()
+            if not stack:
+                return
+            phase = stack[-1][0]
+        stats = self.get_phase(phase)
+        with self._lock:
+            stats.files += files
+            stats.bytes_read += bytes_read
+            stats.bytes_written += bytes_written
+
+    def _count_other_operations(self):
+        """
+        Counts the operations that weren't made in any phase towards "other".
+
+        """
+        if self._operation_log is None:
+            return
+        other = OperationLog()
+        other.update(self._operation_log)
+        for name, phase in list(self.phases.items()):
+            if name == 'other':
+                continue
+            for operation, (count, total) in phase.operations.operations.items():
+                other_count, other_total = other.operations.get(operation,
+                                                                (0, 0.0))
+                other.operations[operation] = (other_count - count,
+                                               other_total - total)
+        other.operations = dict((operation, value) for operation, value
+                                in other.operations.items() if value[0] > 0)
+        if other.operations:
+            self.get_phase('other').operations = other
+
+    def as_dict(self):
+        self._count_other_operations()
+        return {
+            'seconds': round(time.time() - self.started, 6),
+            'phases': SortedDict((name, phase.as_dict()) for name, phase in
+                                 self.phases.items()),
+        }
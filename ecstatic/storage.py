@@ -3,14 +3,25 @@ from django.conf import settings
 from django.contrib.staticfiles import finders
 from django.contrib.staticfiles.storage import (StaticFilesStorage,
         CachedFilesMixin as _CachedFilesMixin)
+from django.contrib.staticfiles.utils import matches_patterns
 from django.core.files import File
-from django.core.files.storage import FileSystemStorage
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from datetime import datetime
 from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
 import itertools
 import os
+import threading
+import time
 import types
-from .manifests import staticfiles_manifest
-from .utils import get_hashed_filename, split_filename
+from .accounting import record_operation
+from .hashcache import get_file_hash_cache
+from .manifests import NotInManifest, staticfiles_manifest
+from .utils import (get_file_hash, get_hashed_filename, link_or_copy,
+                    split_filename)
+
+
+_error_count_lock = threading.Lock()
 
 
 @contextmanager
@@ -29,10 +40,12 @@ def patched_name_fn(storage, fn_name, desc):
                   ' To change this behavior, set your storage\'s `strict`'
                   ' attribute to `False`. Error was: %s'
                   % (desc, name, name, exc))
-            # Increment error count.
-            setattr(self, '_post_process_error_count',
-                    getattr(self, '_post_process_error_count', 0))
-            self._post_process_error_count += 1
+            # Increment error count. Files may be post-processed in several
+            # threads at once, so this needs to be done under a lock.
+            with _error_count_lock:
+                setattr(self, '_post_process_error_count',
+                        getattr(self, '_post_process_error_count', 0))
+                self._post_process_error_count += 1
             return name
 
     method = types.MethodType(patched, storage)
@@ -52,6 +65,8 @@ def post_process_error_counter(storage):
 
 class LaxPostProcessorMixin(object):
     strict = settings.ECSTATIC_STRICT
+    post_process_workers = settings.ECSTATIC_POST_PROCESS_WORKERS
+    post_process_chunk_size = 50
 
     def post_process(self, paths, dry_run=False, **options):
         """
@@ -60,14 +75,56 @@ class LaxPostProcessorMixin(object):
         with post_process_error_counter(self):
             with patched_name_fn(self, 'hashed_name', 'hashed name'):
                 with patched_name_fn(self, 'url', 'url'):
-                    for result in super(LaxPostProcessorMixin,
-                                        self).post_process(paths, dry_run, **options):
+                    if self.post_process_workers > 1 and not dry_run:
+                        processor = self._post_process_in_parallel(paths,
+                                dry_run, **options)
+                    else:
+                        processor = super(LaxPostProcessorMixin,
+                                self).post_process(paths, dry_run, **options)
+                    for result in processor:
                         yield result
             error_count = self._post_process_error_count
             if error_count:
                 print('%s post-processing error%s.' % (error_count,
                         '' if error_count == 1 else 's'))
 
+    def _post_process_in_parallel(self, paths, dry_run=False, **options):
+        """
+        Post-processes files that don't reference other files (i.e. that don't
+        match any of the storage's ``patterns``) in chunks, using
+        ``post_process_workers`` threads, so that hashing and saving overlap.
+        The remaining files (CSS, typically) are processed afterwards, once the
+        files they refer to have been taken care of.
+
+        """
+        super_post_process = super(LaxPostProcessorMixin, self).post_process
+        patterns = list(getattr(self, '_patterns', {}).keys())
+        independent = [name for name in paths if not
+                       matches_patterns(name, patterns)]
+        dependent = dict((name, paths[name]) for name in paths if
+                         matches_patterns(name, patterns))
+
+        chunk_size = self.post_process_chunk_size
+        chunks = [dict((name, paths[name]) for name in
+                       independent[i:i + chunk_size])
+                  for i in range(0, len(independent), chunk_size)]
+
+        def process_chunk(chunk):
+            return list(super_post_process(chunk, dry_run, **options))
+
+        pool = ThreadPool(self.post_process_workers)
+        try:
+            for results in pool.imap(process_chunk, chunks):
+                for result in results:
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+        if dependent:
+            for result in super_post_process(dependent, dry_run, **options):
+                yield result
+
 
 class CachedFilesMixin(LaxPostProcessorMixin, _CachedFilesMixin):
     """
@@ -108,6 +165,8 @@ class UncollectedFileHashMixin(object):
     (which they should be already).
 
     """
+    _hashing = threading.local()
+
     def hashed_name(self, name, content=None):
         if content is None:
             path = finders.find(name)
@@ -116,12 +175,41 @@ class UncollectedFileHashMixin(object):
                 # Really, we should be using the associated storage object to open
                 # the file, but Django doesn't seem to expose that, so we just
                 # assume it's a file on the local filesystem.
-                content = File(open(path))
+                content = File(open(path, 'rb'))
             else:
                 raise ValueError('No static file name "%s" exists.' % name)
 
+            # Remember which local file is being hashed so that ``file_hash``
+            # can consult the persistent hash cache.
+            self._hashing.path = path
+            try:
+                return super(UncollectedFileHashMixin, self).hashed_name(name,
+                                                                         content)
+            finally:
+                self._hashing.path = None
+                content.close()
+
         return super(UncollectedFileHashMixin, self).hashed_name(name, content)
 
+    def file_hash(self, name, content=None):
+        """
+        Overridden to reuse hashes from ``ECSTATIC_HASH_CACHE_FILE`` for local
+        files that haven't changed since they were last hashed.
+
+        """
+        path = getattr(self._hashing, 'path', None)
+        cache = get_file_hash_cache()
+        if path is None or cache is None:
+            return super(UncollectedFileHashMixin, self).file_hash(name, content)
+
+        kind = '%s.%s' % (type(self).__module__, type(self).__name__)
+        fingerprint = cache.fingerprint(path)
+        hash = cache.get(path, kind, fingerprint)
+        if hash is None:
+            hash = super(UncollectedFileHashMixin, self).file_hash(name, content)
+            cache.set(path, kind, fingerprint, hash)
+        return hash
+
 
 class CachedStaticFilesMixin(UncollectedFileHashMixin, CachedFilesMixin):
     pass
@@ -137,21 +225,86 @@ class CachedStaticFilesStorage(CachedFilesMixin, StaticFilesStorage):
 
 # FIXME: extract a mixin
 class HashedNameFileSystemStorage(FileSystemStorage):
-    def get_available_name(self, name):
+    """
+    A file system storage that adds a hash of each file's contents to its name.
+    Saving a file whose hashed name is already taken by the same contents
+    returns the existing name without writing anything. How "the same
+    contents" is checked is controlled by ``verify_existing`` (see
+    ``ECSTATIC_HASHED_NAME_VERIFY``). Files are only saved under numbered names
+    (``name_1.hash.ext``) when the check fails.
+
+    """
+    verify_existing = settings.ECSTATIC_HASHED_NAME_VERIFY
+
+    def _get_candidate_names(self, name):
         dir_name, filename = os.path.split(name)
         basename, hash, ext = split_filename(filename)
 
+        yield name
         count = itertools.count(1)
-        while self.exists(name):
-            name = os.path.join(dir_name, '%s_%s%s%s' % (basename, count.next(),
-                                                         hash, ext))
+        while True:
+            yield os.path.join(dir_name, '%s_%s%s%s' % (basename, next(count),
+                                                        hash, ext))
 
-        return name
+    def get_available_name(self, name):
+        for name in self._get_candidate_names(name):
+            if not self.exists(name):
+                return name
+
+    def get_existing_name(self, name, content):
+        """
+        Returns the name under which the provided contents are already stored,
+        or ``None``.
+
+        """
+        for name in self._get_candidate_names(name):
+            if not self.exists(name):
+                return None
+            if self.is_same_file(name, content):
+                return name
+
+    def is_same_file(self, name, content):
+        if self.verify_existing not in ('size', 'digest'):
+            return True
+        if self.size(name) != content.size:
+            return False
+        if self.verify_existing == 'digest':
+            existing = self.open(name)
+            try:
+                existing_hash = get_file_hash(existing)
+            finally:
+                existing.close()
+            content.seek(0)
+            try:
+                return existing_hash == get_file_hash(content)
+            finally:
+                content.seek(0)
+        return True
 
     def save(self, name, content):
         name = get_hashed_filename(name, content)
+        existing_name = self.get_existing_name(name, content)
+        if existing_name is not None:
+            return existing_name
         return super(HashedNameFileSystemStorage, self).save(name, content)
 
+    def copy(self, name, new_name):
+        """
+        Copies a file (by hard linking it, where possible) and returns the name
+        of the copy.
+
+        """
+        content = File(open(self.path(name), 'rb'))
+        try:
+            existing_name = self.get_existing_name(new_name, content)
+        finally:
+            content.close()
+        if existing_name is not None:
+            return existing_name
+        new_name = self.get_available_name(new_name)
+        link_or_copy(self.path(name), self.path(new_name))
+        return new_name
+
 
 class StaticManifestMixin(object):
     """
@@ -166,3 +319,122 @@ class StaticManifestMixin(object):
             return super(StaticManifestMixin, self).url(name, force)
 
         return staticfiles_manifest.get(name)
+
+    def urls(self, names, force=False):
+        """
+        Returns a list of URLs for the provided names, looking them all up in
+        the manifest at once.
+
+        """
+        names = list(names)
+        if not settings.ECSTATIC_USE_MANIFEST and not force:
+            return [super(StaticManifestMixin, self).url(name, force)
+                    for name in names]
+
+        urls = staticfiles_manifest.get_many(names)
+        return [urls[name] for name in names]
+
+    def gzip_url(self, name):
+        """
+        Returns the URL of the gzipped variant of the file (as saved by
+        ``eccollect --gzip``), or ``None`` if it doesn't have one.
+
+        """
+        try:
+            return staticfiles_manifest.get('%s.gz' % name)
+        except NotInManifest:
+            return None
+
+
+def _accounted(operation):
+    def method(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return getattr(super(OperationAccountingMixin, self),
+                           operation)(*args, **kwargs)
+        finally:
+            record_operation(operation, time.time() - start)
+    method.__name__ = operation
+    return method
+
+
+class OperationAccountingMixin(object):
+    """
+    A mixin that counts and times the storage's operations (see
+    ``ecstatic.accounting``). Use it to check how many calls to a (possibly
+    remote) storage are made by a management command or a request.
+
+    """
+    exists = _accounted('exists')
+    open = _accounted('open')
+    save = _accounted('save')
+    delete = _accounted('delete')
+    modified_time = _accounted('modified_time')
+    size = _accounted('size')
+    url = _accounted('url')
+    listdir = _accounted('listdir')
+
+
+_accounting_storage_classes = {}
+
+
+def get_accounting_storage_class(storage_class):
+    """
+    Returns a subclass of ``storage_class`` that extends
+    ``OperationAccountingMixin``.
+
+    """
+    if issubclass(storage_class, (OperationAccountingMixin,
+                                  AccountingStorage)):
+        return storage_class
+    cls = _accounting_storage_classes.get(storage_class)
+    if cls is None:
+        cls = type('Accounting%s' % storage_class.__name__,
+                   (OperationAccountingMixin, storage_class), {})
+        _accounting_storage_classes[storage_class] = cls
+    return cls
+
+
+class AccountingStorage(object):
+    """
+    Counts and times the operations of the storage named by
+    ``ECSTATIC_ACCOUNTED_STORAGE``. Set ``STATICFILES_STORAGE`` (or a
+    command's ``--storage`` option) to ``'ecstatic.storage.AccountingStorage'``
+    to use it.
+
+    """
+    def __new__(cls, *args, **kwargs):
+        storage_class = get_storage_class(settings.ECSTATIC_ACCOUNTED_STORAGE)
+        return get_accounting_storage_class(storage_class)(*args, **kwargs)
+
+
+def get_bulk_listing(storage):
+    """
+    Returns a list of ``(name, modified_time)`` pairs for every file in the
+    storage, or ``None`` if the storage can't be listed in bulk. Storages can
+    provide a ``bulk_listing`` method that returns such pairs (the time may be
+    ``None`` if it isn't known); file system storages are walked directly,
+    with a single ``stat`` per file.
+
+    """
+    bulk_listing = getattr(storage, 'bulk_listing', None)
+    if bulk_listing is not None:
+        return list(bulk_listing())
+    if not isinstance(storage, FileSystemStorage):
+        return None
+
+    listing = []
+    location = storage.location
+    # Like ``FileSystemStorage.listdir``, symlinked directories are listed.
+    for dir_path, dir_names, file_names in os.walk(location, followlinks=True):
+        dir_name = os.path.relpath(dir_path, location)
+        for file_name in file_names:
+            try:
+                modified_time = datetime.fromtimestamp(
+                    os.stat(os.path.join(dir_path, file_name)).st_mtime)
+            except OSError:
+                modified_time = None
+            if dir_name != os.curdir:
+                file_name = os.path.join(dir_name, file_name)
+            listing.append((file_name, modified_time))
+    return listing
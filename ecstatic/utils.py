@@ -1,7 +1,14 @@
 from contextlib import contextmanager
 from django.conf import settings
-from hashlib import md5
+import gzip
+import hashlib
+import io
+import os
+import posixpath
 import re
+import shutil
+import stat
+import tempfile
 
 
 @contextmanager
@@ -18,6 +25,34 @@ def patched_settings(**kwargs):
         setattr(settings, k, v)
 
 
+replace_file = getattr(os, 'replace', os.rename)
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Opens a temporary file next to ``path`` for writing and, once the block
+    exits cleanly, moves it into place. Readers will see either the old file or
+    the new one, never a partially written one.
+
+    """
+    dir_name, filename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.%s.' % filename,
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+        try:
+            permissions = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            permissions = 0o644
+        os.chmod(tmp_path, permissions)
+        replace_file(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 hashed_filename_pattern = r"""
     (?P<name>.+?)                  # A basename that's at least 1 char long
     (
@@ -40,12 +75,145 @@ def get_hashed_filename(name, file, suffix=None):
     """
     basename, hash, ext = split_filename(name)
     file.seek(0)
-    new_hash = '.%s' % md5(file.read()).hexdigest()[:12]
+    new_hash = '.%s' % get_file_hash(file)[:12]
     if suffix is not None:
         basename = '%s_%s' % (basename, suffix)
     return '%s%s%s' % (basename, new_hash, ext)
 
 
+def link_or_copy(path, new_path):
+    """
+    Hard links ``new_path`` to ``path`` or, if that isn't possible (for
+    example, because they're on different devices), copies it.
+
+    """
+    dir_name = os.path.dirname(new_path)
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    try:
+        os.link(path, new_path)
+    except (AttributeError, OSError):
+        shutil.copyfile(path, new_path)
+
+
+def copy_stored_file(storage, name, new_name):
+    """
+    Copies a file within a storage without reading it through Python, if the
+    storage allows it. Storages can provide a ``copy(name, new_name)`` method
+    (which should return the name the copy was saved under) that uses a
+    server-side copy; files in local storages are linked or copied on disk.
+    Returns the name of the copy, or ``None`` if the file needs to be saved
+    again instead.
+
+    """
+    copy = getattr(storage, 'copy', None)
+    if copy is not None:
+        return copy(name, new_name)
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        return None
+    new_name = storage.get_available_name(new_name)
+    link_or_copy(path, storage.path(new_name))
+    return new_name
+
+
+def get_file_hash(file, algorithm=None, chunk_size=64 * 1024):
+    """
+    Returns the hexdigest of the rest of the file's contents, computed with the
+    named hashlib algorithm (``ECSTATIC_HASH_ALGORITHM`` by default). The file
+    is read in chunks, into a single reusable buffer if it supports
+    ``readinto``, so large files are never held in memory.
+
+    """
+    hasher = hashlib.new(algorithm or settings.ECSTATIC_HASH_ALGORITHM)
+    readinto = getattr(file, 'readinto', None)
+    if readinto is not None:
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        try:
+            length = readinto(buf)
+        except io.UnsupportedOperation:
+            pass
+        else:
+            while length:
+                hasher.update(view[:length])
+                length = readinto(buf)
+            return hasher.hexdigest()
+
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def compress_file(path=None, content=None, level=9):
+    """
+    Gzips the file at ``path`` (or the bytes in ``content``) and returns the
+    compressed bytes, or ``None`` if compressing doesn't make it any smaller.
+    The output doesn't depend on the time it was made, so the same input always
+    produces the same variant. This is a plain function so that it can be run
+    in a process pool.
+
+    """
+    if content is None:
+        with open(path, 'rb') as file:
+            content = file.read()
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                       compresslevel=level, mtime=0) as file:
+        file.write(content)
+    compressed = buf.getvalue()
+    if len(compressed) >= len(content):
+        return None
+    return compressed
+
+
+def get_gzip_url(url):
+    """
+    Returns the URL of the gzipped variant of the file at ``url``.
+
+    """
+    url, query = (url.split('?', 1) + [None])[:2]
+    url = '%s.gz' % url
+    return url if query is None else '%s?%s' % (url, query)
+
+
+def find_referenced_names(name, content, patterns):
+    """
+    Returns the set of static file names referenced by URLs in ``content``,
+    the contents of the static file ``name``. ``patterns`` are compiled regular
+    expressions like those used by ``CachedFilesMixin``, in which the URL is
+    either the group named "url" or the second group.
+
+    """
+    names = set()
+    base_dir = posixpath.dirname(name.replace('\\', '/'))
+    for pattern in patterns:
+        for match in pattern.finditer(content):
+            url = match.groupdict().get('url') or match.groups()[1]
+            url = url.strip().split('#', 1)[0].split('?', 1)[0]
+            if not url or url.startswith('//'):
+                # Fragments and protocol-relative URLs.
+                continue
+            if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', url):
+                # Data URIs and absolute URLs.
+                continue
+            if url.startswith('/'):
+                static_url = settings.STATIC_URL or ''
+                if not static_url or not url.startswith(static_url):
+                    continue
+                url = url[len(static_url):]
+            else:
+                url = posixpath.join(base_dir, url)
+            names.add(posixpath.normpath(url))
+    return names
+
+
 def split_filename(name):
     """
     Splits the filename into three parts: the name part, the hash part, and the
@@ -24,7 +24,7 @@ setup(
     author_email='m@tthewwithanm.com',
     url='http://github.com/hzdg/django-ecstatic',
     download_url='http://github.com/hzdg/django-ecstatic/tarball/master',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     zip_safe=False,
     include_package_data=True,
     tests_require=[
@@ -0,0 +1,5 @@
+import django
+
+
+if hasattr(django, 'setup'):
+    django.setup()
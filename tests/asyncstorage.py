@@ -0,0 +1,47 @@
+"""
+A local storage with the async methods used by ``eccollect --engine async``.
+Kept out of the test modules because it requires Python 3.5 or later.
+
+"""
+from django.contrib.staticfiles.storage import StaticFilesStorage
+import asyncio
+
+
+class FakeAsyncStorage(StaticFilesStorage):
+    """
+    Records the async calls made to it. Saving a file whose name is in
+    ``failing`` raises an ``IOError``. Like a real async storage, the async
+    methods don't go through the synchronous ones (which may be accounted
+    separately).
+
+    """
+    calls = []
+    failing = set()
+
+    @property
+    def backend(self):
+        return StaticFilesStorage(location=self.location,
+                                  base_url=self.base_url)
+
+    async def _call(self, operation, name):
+        # Give the other files in flight a chance to run.
+        await asyncio.sleep(0)
+        type(self).calls.append((operation, name))
+
+    async def async_exists(self, name):
+        await self._call('exists', name)
+        return self.backend.exists(name)
+
+    async def async_modified_time(self, name):
+        await self._call('modified_time', name)
+        return self.backend.modified_time(name)
+
+    async def async_delete(self, name):
+        await self._call('delete', name)
+        return self.backend.delete(name)
+
+    async def async_save(self, name, content):
+        await self._call('save', name)
+        if name in self.failing:
+            raise IOError('Could not save "%s".' % name)
+        return self.backend.save(name, content)
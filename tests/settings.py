@@ -4,3 +4,14 @@ DATABASES = {
         'NAME': 'testdb'
     }
 }
+
+SECRET_KEY = 'ecstatic-tests'
+
+INSTALLED_APPS = [
+    'django.contrib.staticfiles',
+    'ecstatic',
+]
+
+MIDDLEWARE_CLASSES = ()
+
+STATIC_URL = '/static/'
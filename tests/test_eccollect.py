@@ -0,0 +1,496 @@
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import StaticFilesStorage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from ecstatic.manifests import JsonManifest
+from ecstatic.storage import CachedStaticFilesStorage, StaticManifestMixin
+
+
+requires_async = unittest.skipIf(sys.version_info < (3, 5),
+                                 'The async engine requires Python 3.5.')
+
+if sys.version_info >= (3, 5):
+    from .asyncstorage import FakeAsyncStorage
+
+
+class FailingStorage(StaticFilesStorage):
+    """
+    Records the files saved to it. Saving a file whose name is in ``failing``
+    raises an ``IOError``.
+
+    """
+    saved = []
+    failing = set()
+
+    def _save(self, name, content):
+        if name in self.failing:
+            raise IOError('Could not save "%s".' % name)
+        type(self).saved.append(name)
+        return super(FailingStorage, self)._save(name, content)
+
+
+class RecordingStorage(StaticFilesStorage):
+    """
+    Records the files opened and saved through it.
+
+    """
+    calls = []
+
+    def _open(self, name, mode='rb'):
+        type(self).calls.append(('open', name))
+        return super(RecordingStorage, self)._open(name, mode)
+
+    def _save(self, name, content):
+        type(self).calls.append(('save', name))
+        return super(RecordingStorage, self)._save(name, content)
+
+
+class ListingStorage(StaticFilesStorage):
+    """
+    Records the existence and modified time checks made through it.
+
+    """
+    calls = []
+
+    def exists(self, name):
+        type(self).calls.append(('exists', name))
+        return super(ListingStorage, self).exists(name)
+
+    def modified_time(self, name):
+        type(self).calls.append(('modified_time', name))
+        return super(ListingStorage, self).modified_time(name)
+
+
+class ManifestStorage(StaticManifestMixin, CachedStaticFilesStorage):
+    pass
+
+
+class BrokenStorage(StaticFilesStorage):
+    """
+    Records the files it's asked to save, and raises a ``ValueError`` instead
+    of saving them.
+
+    """
+    attempts = []
+
+    def _save(self, name, content):
+        type(self).attempts.append(name)
+        raise ValueError('Not a transient error.')
+
+
+def clear_finders():
+    if hasattr(finders.get_finder, 'cache_clear'):
+        finders.get_finder.cache_clear()
+    else:
+        finders._finders.clear()
+
+
+class CollectTestCase(unittest.TestCase):
+    files = {
+        'css/a.css': 'body { color: red; }',
+        'css/b.css': 'body { color: blue; }',
+        'js/c.js': 'var c = 1;',
+    }
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.root, 'source')
+        self.destination_dir = os.path.join(self.root, 'collected')
+        for name, content in self.files.items():
+            path = os.path.join(self.source_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as file:
+                file.write(content)
+
+        self.settings = override_settings(
+            STATICFILES_DIRS=[self.source_dir],
+            STATIC_ROOT=self.destination_dir,
+            STATICFILES_FINDERS=[
+                'django.contrib.staticfiles.finders.FileSystemFinder'],
+        )
+        self.settings.enable()
+        clear_finders()
+
+        RecordingStorage.calls = []
+        ListingStorage.calls = []
+        BrokenStorage.attempts = []
+        FailingStorage.saved = []
+        FailingStorage.failing = set()
+        if sys.version_info >= (3, 5):
+            FakeAsyncStorage.calls = []
+            FakeAsyncStorage.failing = set()
+
+    def tearDown(self):
+        self.settings.disable()
+        clear_finders()
+        shutil.rmtree(self.root)
+
+    def collect(self, **options):
+        options.setdefault('interactive', False)
+        options.setdefault('verbosity', 0)
+        call_command('eccollect', **options)
+
+    def set_modified_time(self, path, timestamp):
+        os.utime(path, (timestamp, timestamp))
+
+
+@requires_async
+class AsyncEngineTest(CollectTestCase):
+    storage = 'tests.asyncstorage.FakeAsyncStorage'
+
+    def test_uses_async_methods(self):
+        self.collect(engine='async', storage_override=self.storage)
+        for name in self.files:
+            self.assertTrue(os.path.exists(os.path.join(self.destination_dir,
+                                                        name)))
+            self.assertIn(('save', name), FakeAsyncStorage.calls)
+
+        FakeAsyncStorage.calls = []
+        self.collect(engine='async', storage_override=self.storage)
+        self.assertEqual([name for operation, name in FakeAsyncStorage.calls
+                          if operation == 'save'], [])
+
+    def test_engines_agree_on_modified_times(self):
+        self.collect(storage_override=self.storage)
+        source_path = os.path.join(self.source_dir, 'css', 'a.css')
+        destination_path = os.path.join(self.destination_dir, 'css', 'a.css')
+
+        # The destination is older, but only by a fraction of a second.
+        now = int(time.time()) - 60
+        self.set_modified_time(source_path, now + 0.7)
+        self.set_modified_time(destination_path, now + 0.2)
+
+        self.collect(storage_override=self.storage)
+        self.assertEqual(os.path.getmtime(destination_path), now + 0.2)
+        self.collect(engine='async', storage_override=self.storage)
+        self.assertNotIn(('save', 'css/a.css'), FakeAsyncStorage.calls)
+
+        # A whole second is enough for both.
+        self.set_modified_time(destination_path, now - 1)
+        self.collect(engine='async', storage_override=self.storage)
+        self.assertIn(('save', 'css/a.css'), FakeAsyncStorage.calls)
+
+    def test_stats_phases(self):
+        stats_file = os.path.join(self.root, 'stats.json')
+
+        def get_storage_calls(**options):
+            self.collect(engine='async', stats_json=stats_file, **options)
+            with open(stats_file) as file:
+                phases = json.load(file)['phases']
+            self.assertNotIn('other', phases)
+            return dict((name, phase['storage_calls'])
+                        for name, phase in phases.items())
+
+        storage_calls = get_storage_calls()
+        self.assertEqual(storage_calls['compare:modified_time'],
+                         {'exists': 3})
+        self.assertEqual(storage_calls['transfer']['save'], 3)
+
+        storage_calls = get_storage_calls()
+        self.assertEqual(storage_calls['compare:modified_time'],
+                         {'exists': 3, 'modified_time': 3})
+
+        # Storages with async methods.
+        shutil.rmtree(self.destination_dir)
+        storage_calls = get_storage_calls(
+            storage_override='tests.asyncstorage.FakeAsyncStorage')
+        self.assertEqual(storage_calls['compare:modified_time'],
+                         {'exists': 3})
+        self.assertEqual(storage_calls['transfer'], {'save': 3})
+
+
+class JournalTest(CollectTestCase):
+    def get_journal_path(self):
+        return os.path.join(self.root, 'journal')
+
+    def check_resume(self, storage_class, **options):
+        storage = '%s.%s' % (storage_class.__module__, storage_class.__name__)
+        journal = self.get_journal_path()
+        storage_class.failing = set(['css/b.css'])
+        with self.assertRaises(CommandError):
+            self.collect(storage_override=storage, journal=journal, retries=0,
+                         **options)
+        self.assertTrue(os.path.exists(journal))
+        self.assertFalse(os.path.exists(os.path.join(self.destination_dir,
+                                                     'css', 'b.css')))
+
+        storage_class.failing = set()
+        output = StringIO()
+        self.collect(storage_override=storage, journal=journal, resume=True,
+                     verbosity=2, stdout=output, **options)
+        self.assertIn("Skipping 'css/a.css' (already collected, according to"
+                      " the journal)", output.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir,
+                                                    'css', 'b.css')))
+        self.assertFalse(os.path.exists(journal))
+
+    def test_resume(self):
+        self.check_resume(FailingStorage)
+        self.assertEqual(FailingStorage.saved.count('css/a.css'), 1)
+        self.assertEqual(FailingStorage.saved.count('css/b.css'), 1)
+
+    @requires_async
+    def test_resume_async(self):
+        self.check_resume(FakeAsyncStorage, engine='async')
+        # The journaled file wasn't even looked at the second time.
+        self.assertEqual(FakeAsyncStorage.calls.count(('exists', 'css/a.css')),
+                         1)
+        self.assertEqual(FakeAsyncStorage.calls.count(('save', 'css/b.css')),
+                         2)
+
+    def test_non_transient_errors_abort(self):
+        journal = self.get_journal_path()
+        with self.assertRaises(ValueError):
+            self.collect(storage_override='%s.BrokenStorage' % __name__,
+                         journal=journal, retries=3)
+        # The first file wasn't retried, and nothing else was tried.
+        self.assertEqual(len(BrokenStorage.attempts), 1)
+        # The journal is kept, without recording any file as collected.
+        with open(journal) as file:
+            entries = [json.loads(line) for line in file]
+        self.assertEqual(len(entries), 1)
+        self.assertIn('storage', entries[0])
+
+
+class HashIndexTest(CollectTestCase):
+    storage = 'tests.test_eccollect.RecordingStorage'
+
+    def test_index_is_kept_locally(self):
+        index_file = os.path.join(self.root, 'hash-index.json')
+        with override_settings(ECSTATIC_COLLECT_HASH_INDEX=index_file):
+            self.collect(comparison_method='file_hash',
+                         storage_override=self.storage)
+            self.assertTrue(os.path.exists(index_file))
+            self.assertEqual(sorted(os.listdir(self.destination_dir)),
+                             ['css', 'js'])
+
+            # The destination files don't have to be read to be compared.
+            RecordingStorage.calls = []
+            self.collect(comparison_method='file_hash',
+                         storage_override=self.storage)
+            self.assertEqual(RecordingStorage.calls, [])
+
+            with open(os.path.join(self.source_dir, 'css', 'a.css'),
+                      'w') as file:
+                file.write('body { color: green; }')
+            self.collect(comparison_method='file_hash',
+                         storage_override=self.storage)
+            self.assertEqual(RecordingStorage.calls, [('save', 'css/a.css')])
+
+    def test_index_next_to_state_file(self):
+        state_file = os.path.join(self.root, 'state.json')
+        self.collect(comparison_method='file_hash', state_file=state_file,
+                     storage_override=self.storage)
+        self.assertTrue(os.path.exists('%s.hashes' % state_file))
+
+
+class PrefetchTest(CollectTestCase):
+    storage = 'tests.test_eccollect.ListingStorage'
+
+    def test_file_system_storage_is_listed_in_bulk(self):
+        self.collect(storage_override=self.storage)
+        self.assertTrue(ListingStorage.calls)
+
+        ListingStorage.calls = []
+        self.collect(storage_override=self.storage, prefetch_listing=True)
+        self.assertEqual(ListingStorage.calls, [])
+
+        # Modified files are still noticed.
+        path = os.path.join(self.source_dir, 'css', 'a.css')
+        with open(path, 'w') as file:
+            file.write('body { color: green; }')
+        self.set_modified_time(path, time.time() + 60)
+        self.collect(storage_override=self.storage, prefetch_listing=True)
+        with open(os.path.join(self.destination_dir, 'css', 'a.css')) as file:
+            self.assertEqual(file.read(), 'body { color: green; }')
+
+
+class GzipTest(CollectTestCase):
+    files = dict(CollectTestCase.files, **{
+        'js/big.js': 'var big = 1;\n' * 200,
+    })
+    storage = 'tests.test_eccollect.ManifestStorage'
+
+    def setUp(self):
+        super(GzipTest, self).setUp()
+        self.manifest_settings = override_settings(
+            ECSTATIC_MANIFEST_FILE=os.path.join(self.root, 'manifest.json'),
+            ECSTATIC_MANIFEST='ecstatic.manifests.JsonManifest',
+        )
+        self.manifest_settings.enable()
+
+    def tearDown(self):
+        self.manifest_settings.disable()
+        super(GzipTest, self).tearDown()
+
+    def gzip_exists(self, name):
+        return os.path.exists(os.path.join(self.destination_dir,
+                                           '%s.gz' % name))
+
+    def collect(self, **options):
+        super(GzipTest, self).collect(**options)
+        self.hashed_name = ManifestStorage().hashed_name('js/big.js')
+
+    def test_compresses_eligible_files(self):
+        self.collect(gzip=True, storage_override=self.storage)
+        self.assertNotEqual(self.hashed_name, 'js/big.js')
+        self.assertTrue(self.gzip_exists('js/big.js'))
+        self.assertTrue(self.gzip_exists(self.hashed_name))
+        self.assertFalse(self.gzip_exists('js/c.js'))
+        self.assertEqual(JsonManifest().load(),
+                         {'js/big.js.gz': '/static/%s.gz' % self.hashed_name})
+
+    def test_deletes_variants_of_ineligible_files(self):
+        self.collect(gzip=True, storage_override=self.storage)
+        with override_settings(ECSTATIC_GZIP_MIN_SIZE=10 ** 6):
+            self.collect(gzip=True, storage_override=self.storage)
+        self.assertFalse(self.gzip_exists('js/big.js'))
+        self.assertFalse(self.gzip_exists(self.hashed_name))
+        self.assertEqual(JsonManifest().load(), {})
+
+    def test_createstaticmanifest_checks_variants(self):
+        self.collect(gzip=True, storage_override=self.storage)
+        call_command('createstaticmanifest', storage_override=self.storage)
+        self.assertEqual(JsonManifest().load()['js/big.js.gz'],
+                         '/static/%s.gz' % self.hashed_name)
+
+        # The URL changes, and the variant still exists.
+        with override_settings(STATIC_URL='/assets/'):
+            call_command('createstaticmanifest',
+                         storage_override=self.storage)
+        self.assertEqual(JsonManifest().load()['js/big.js.gz'],
+                         '/assets/%s.gz' % self.hashed_name)
+
+        # The URL changes, and the variant is gone.
+        os.remove(os.path.join(self.destination_dir,
+                               '%s.gz' % self.hashed_name))
+        call_command('createstaticmanifest', storage_override=self.storage)
+        manifest = JsonManifest().load()
+        self.assertEqual(manifest['js/big.js'],
+                         '/static/%s' % self.hashed_name)
+        self.assertNotIn('js/big.js.gz', manifest)
+
+
+class DedupeTest(CollectTestCase):
+    files = dict(CollectTestCase.files, **{'js/lib.js': 'var lib = 1;'})
+    storage = 'tests.test_eccollect.ManifestStorage'
+
+    def setUp(self):
+        super(DedupeTest, self).setUp()
+        # A second, prefixed, directory with copies of js/lib.js.
+        vendor_dir = os.path.join(self.root, 'vendor')
+        os.makedirs(os.path.join(vendor_dir, 'js'))
+        for name in ('lib.js', 'copy.js'):
+            with open(os.path.join(vendor_dir, 'js', name), 'w') as file:
+                file.write(self.files['js/lib.js'])
+        self.dedupe_settings = override_settings(
+            STATICFILES_DIRS=[self.source_dir, ('vendor', vendor_dir)],
+            ECSTATIC_MANIFEST_FILE=os.path.join(self.root, 'manifest.json'),
+            ECSTATIC_MANIFEST='ecstatic.manifests.JsonManifest',
+        )
+        self.dedupe_settings.enable()
+        clear_finders()
+
+    def tearDown(self):
+        self.dedupe_settings.disable()
+        super(DedupeTest, self).tearDown()
+
+    def test_duplicates_in_several_directories(self):
+        stdout = StringIO()
+        self.collect(dedupe=True, storage_override=self.storage,
+                     verbosity=2, stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn("Skipping 'vendor/js/lib.js' (duplicate of 'js/lib.js')",
+                      output)
+        self.assertIn("Skipping 'vendor/js/copy.js' (duplicate of"
+                      " 'js/lib.js')", output)
+        self.assertFalse(os.path.exists(os.path.join(self.destination_dir,
+                                                     'vendor')))
+
+        call_command('createstaticmanifest', dedupe=True,
+                     storage_override=self.storage)
+        manifest = JsonManifest().load()
+        url = '/static/%s' % ManifestStorage().hashed_name('js/lib.js')
+        self.assertEqual(manifest['js/lib.js'], url)
+        self.assertEqual(manifest['js/copy.js'], url)
+
+
+class IncrementalPostProcessTest(CollectTestCase):
+    files = {
+        'css/app.css': 'body { background: url(../img/logo.png); }',
+        'img/logo.png': 'logo',
+        'js/c.js': 'var c = 1;',
+    }
+
+    def setUp(self):
+        super(IncrementalPostProcessTest, self).setUp()
+        self.index_file = os.path.join(self.root, 'dependencies.json')
+        self.index_settings = override_settings(
+            ECSTATIC_COLLECT_DEPENDENCY_INDEX=self.index_file)
+        self.index_settings.enable()
+
+    def tearDown(self):
+        self.index_settings.disable()
+        super(IncrementalPostProcessTest, self).tearDown()
+
+    def collect_incrementally(self, **options):
+        """
+        Collects, returning the names of the files that were passed to the
+        storage's ``post_process`` method.
+
+        """
+        stdout = StringIO()
+        self.collect(pp='incremental', verbosity=2, stdout=stdout,
+                     storage_override='ecstatic.storage.'
+                                      'CachedStaticFilesStorage', **options)
+        return set(re.findall(r"(?:Post-processed|Skipped post-processing)"
+                              r" '([^']+)'", stdout.getvalue()))
+
+    def change(self, name, content):
+        path = os.path.join(self.source_dir, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        # Older than the copy that's about to be made, but newer than the
+        # collected one.
+        now = time.time()
+        self.set_modified_time(path, now - 60)
+        self.set_modified_time(os.path.join(self.destination_dir, name),
+                               now - 120)
+
+    def test_post_processes_changed_files_and_dependents(self):
+        self.assertEqual(self.collect_incrementally(), set(self.files))
+        with open(self.index_file) as file:
+            self.assertEqual(json.load(file)['dependents'],
+                             {'img/logo.png': ['css/app.css']})
+        self.assertEqual(sorted(os.listdir(self.destination_dir)),
+                         ['css', 'img', 'js'])
+
+        self.assertEqual(self.collect_incrementally(), set())
+
+        self.change('js/c.js', 'var c = 2;')
+        self.assertEqual(self.collect_incrementally(), set(['js/c.js']))
+
+        self.change('img/logo.png', 'new logo')
+        self.assertEqual(self.collect_incrementally(),
+                         set(['img/logo.png', 'css/app.css']))
+
+    def test_without_index(self):
+        with override_settings(ECSTATIC_COLLECT_DEPENDENCY_INDEX=None):
+            self.assertEqual(self.collect_incrementally(), set(self.files))
+            self.assertEqual(self.collect_incrementally(), set(self.files))
+
+            # Next to the state file.
+            state_file = os.path.join(self.root, 'state.json')
+            self.collect_incrementally(state_file=state_file)
+            self.assertTrue(os.path.exists('%s.dependencies' % state_file))
@@ -0,0 +1,147 @@
+from django.contrib.staticfiles.storage import StaticFilesStorage
+from django.test.utils import override_settings
+import django
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from ecstatic.hashcache import (FileHashCache, get_file_hash_cache,
+                                logger as hashcache_logger)
+from ecstatic.storage import CachedStaticFilesMixin
+from .test_eccollect import clear_finders
+
+
+class CachedStorage(CachedStaticFilesMixin, StaticFilesStorage):
+    pass
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class FileHashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'app.js')
+        self.write('var a = 1;')
+        self.cache = FileHashCache(os.path.join(self.root, 'hashes.db'))
+        self.handler = RecordingHandler()
+        hashcache_logger.addHandler(self.handler)
+
+    def tearDown(self):
+        hashcache_logger.removeHandler(self.handler)
+        shutil.rmtree(self.root)
+
+    def write(self, content, mtime=None):
+        with open(self.path, 'w') as file:
+            file.write(content)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_get_and_set(self):
+        fingerprint = self.cache.fingerprint(self.path)
+        self.assertEqual(self.cache.get(self.path, 'md5', fingerprint), None)
+        self.cache.set(self.path, 'md5', fingerprint, 'abc')
+        self.assertEqual(self.cache.get(self.path, 'md5', fingerprint), 'abc')
+        self.assertEqual(self.cache.get(self.path, 'sha1', fingerprint), None)
+
+        # Another process (or thread) sees the same entries.
+        other = FileHashCache(self.cache.path)
+        self.assertEqual(other.get(self.path, 'md5', fingerprint), 'abc')
+
+    def test_changed_file(self):
+        self.write('var a = 1;', mtime=1000000000)
+        self.cache.set(self.path, 'md5', self.cache.fingerprint(self.path),
+                       'abc')
+        # Same size, different modification time.
+        self.write('var a = 2;', mtime=1000000001)
+        self.assertEqual(self.cache.get(self.path, 'md5',
+                                        self.cache.fingerprint(self.path)),
+                         None)
+        # Different size, same modification time.
+        self.write('var a = 10;', mtime=1000000000)
+        self.assertEqual(self.cache.get(self.path, 'md5',
+                                        self.cache.fingerprint(self.path)),
+                         None)
+
+    def test_unusable_database(self):
+        cache = FileHashCache(os.path.join(self.root, 'missing', 'hashes.db'))
+        fingerprint = cache.fingerprint(self.path)
+        cache.set(self.path, 'md5', fingerprint, 'abc')
+        self.assertEqual(cache.get(self.path, 'md5', fingerprint), None)
+        self.assertEqual(len(self.handler.records), 2)
+
+    def test_locked_database(self):
+        self.cache.timeout = 0.1
+        fingerprint = self.cache.fingerprint(self.path)
+        self.cache.set(self.path, 'md5', fingerprint, 'abc')
+        other = sqlite3.connect(self.cache.path)
+        try:
+            other.execute('BEGIN EXCLUSIVE')
+            self.assertEqual(self.cache.get(self.path, 'md5', fingerprint),
+                             None)
+            self.cache.set(self.path, 'md5', fingerprint, 'def')
+        finally:
+            other.rollback()
+            other.close()
+        self.assertEqual(len(self.handler.records), 2)
+        self.assertEqual(self.cache.get(self.path, 'md5', fingerprint), 'abc')
+
+    def test_get_file_hash_cache(self):
+        with override_settings(ECSTATIC_HASH_CACHE_FILE=None):
+            self.assertEqual(get_file_hash_cache(), None)
+        with override_settings(ECSTATIC_HASH_CACHE_FILE=self.cache.path):
+            cache = get_file_hash_cache()
+            self.assertEqual(cache.path, self.cache.path)
+            self.assertTrue(get_file_hash_cache() is cache)
+
+
+@unittest.skipIf(django.VERSION < (1, 7),
+                 'The hash cache has no effect before Django 1.7.')
+class UncollectedFileHashMixinTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.root, 'source')
+        os.makedirs(os.path.join(self.source_dir, 'js'))
+        self.path = os.path.join(self.source_dir, 'js', 'app.js')
+        with open(self.path, 'w') as file:
+            file.write('var a = 1;')
+        self.cache_file = os.path.join(self.root, 'hashes.db')
+        self.settings = override_settings(
+            STATICFILES_DIRS=[self.source_dir],
+            STATIC_ROOT=os.path.join(self.root, 'collected'),
+            ECSTATIC_HASH_CACHE_FILE=self.cache_file,
+        )
+        self.settings.enable()
+        clear_finders()
+
+    def tearDown(self):
+        self.settings.disable()
+        clear_finders()
+        shutil.rmtree(self.root)
+
+    def test_reuses_cached_hashes(self):
+        hashed_name = CachedStorage().hashed_name('js/app.js')
+        self.assertNotEqual(hashed_name, 'js/app.js')
+
+        # Replace the cached hash, to show that it's used instead of hashing
+        # the file again.
+        cache = get_file_hash_cache()
+        kind = '%s.%s' % (CachedStorage.__module__, CachedStorage.__name__)
+        fingerprint = cache.fingerprint(self.path)
+        self.assertTrue(cache.get(self.path, kind, fingerprint))
+        cache.set(self.path, kind, fingerprint, 'cached')
+        self.assertEqual(CachedStorage().hashed_name('js/app.js'),
+                         'js/app.cached.js')
+
+        with open(self.path, 'w') as file:
+            file.write('var a = 2; // changed')
+        self.assertNotIn(CachedStorage().hashed_name('js/app.js'),
+                         (hashed_name, 'js/app.cached.js'))
@@ -0,0 +1,128 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db.models.fields.files import FileDescriptor, FileField
+import os
+import shutil
+import tempfile
+import unittest
+from ecstatic.management.commands.hashmedianames import Command
+from ecstatic.storage import HashedNameFileSystemStorage
+from ecstatic.utils import get_hashed_filename
+
+
+def make_document_class(storage):
+    """
+    Returns a class with a file field attribute, like a model's, that stores
+    its files in ``storage``.
+
+    """
+    field = FileField(storage=storage, upload_to='docs')
+    field.set_attributes_from_name('file')
+
+    class Document(object):
+        file = FileDescriptor(field)
+
+        def __init__(self, name):
+            self.file = name
+
+    return Document
+
+
+class RenameTestCase(unittest.TestCase):
+    storage_class = FileSystemStorage
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = self.storage_class(location=self.root)
+        self.Document = make_document_class(self.storage)
+        self.command = Command()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as file:
+            file.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as file:
+            return file.read()
+
+    def hashed_name(self, name, content):
+        return get_hashed_filename(name, ContentFile(content))
+
+
+class RenameFileTest(RenameTestCase):
+    def test_copies_file(self):
+        self.write('docs/a.txt', b'aaa')
+        document = self.Document('docs/a.txt')
+        self.assertTrue(self.command.rename_file(document, 'file'))
+
+        hashed_name = self.hashed_name('docs/a.txt', b'aaa')
+        self.assertNotEqual(hashed_name, 'docs/a.txt')
+        self.assertEqual(document.file.name, hashed_name)
+        self.assertEqual(self.read(hashed_name), b'aaa')
+        # The original is left in place.
+        self.assertEqual(self.read('docs/a.txt'), b'aaa')
+
+        self.assertFalse(self.command.rename_file(document, 'file'))
+
+    def test_rename_files(self):
+        self.write('docs/a.txt', b'aaa')
+        document = self.Document('docs/a.txt')
+        self.assertEqual(self.command.rename_files(document, ['file']),
+                         [('file', 'docs/a.txt',
+                           self.hashed_name('docs/a.txt', b'aaa'))])
+        self.assertEqual(self.command.rename_files(document, ['file']), [])
+
+    def test_empty_field(self):
+        document = self.Document('')
+        self.assertFalse(self.command.rename_file(document, 'file'))
+
+
+class HashedNameFileSystemStorageTest(RenameTestCase):
+    storage_class = HashedNameFileSystemStorage
+
+    def test_reuses_identical_copy(self):
+        self.write('docs/a.txt', b'aaa')
+        first, second = self.Document('docs/a.txt'), self.Document('docs/a.txt')
+        self.assertTrue(self.command.rename_file(first, 'file'))
+        self.assertTrue(self.command.rename_file(second, 'file'))
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'docs'))),
+                         sorted(['a.txt', os.path.basename(first.file.name)]))
+
+    def test_verify_existing(self):
+        hashed_name = self.hashed_name('docs/a.txt', b'aaa')
+        # Another file that happens to have the name.
+        self.write(hashed_name, b'other')
+        self.write('docs/a.txt', b'aaa')
+
+        # Matching names are trusted by default.
+        document = self.Document('docs/a.txt')
+        self.assertTrue(self.command.rename_file(document, 'file'))
+        self.assertEqual(document.file.name, hashed_name)
+
+        self.storage.verify_existing = 'size'
+        document = self.Document('docs/a.txt')
+        self.assertTrue(self.command.rename_file(document, 'file'))
+        numbered_name = 'docs/a_1%s.txt' % os.path.splitext(
+            os.path.splitext(hashed_name)[0])[1]
+        self.assertEqual(document.file.name, numbered_name)
+        self.assertEqual(self.read(numbered_name), b'aaa')
+
+        # Once it's been saved under the numbered name, that copy is reused.
+        document = self.Document('docs/a.txt')
+        self.command.rename_file(document, 'file')
+        self.assertEqual(document.file.name, numbered_name)
+
+    def test_save_reuses_identical_file(self):
+        name = self.storage.save('docs/b.txt', ContentFile(b'bbb'))
+        self.assertEqual(name, self.hashed_name('docs/b.txt', b'bbb'))
+        self.assertEqual(self.storage.save('docs/b.txt', ContentFile(b'bbb')),
+                         name)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'docs')),
+                         [os.path.basename(name)])
@@ -0,0 +1,255 @@
+from django.test.utils import override_settings
+import os
+import shutil
+import tempfile
+import unittest
+from ecstatic.manifests import (BinaryManifest, JsonManifest, NotInManifest,
+                                SqliteManifest)
+
+
+class CountingCache(object):
+    """
+    Wraps a cache, counting the calls that write to it.
+
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.writes = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.cache, name)
+        if name in ('add', 'set', 'set_many'):
+            def write(*args, **kwargs):
+                self.writes += 1
+                return attr(*args, **kwargs)
+            return write
+        return attr
+
+
+class ManifestTestCase(unittest.TestCase):
+    manifest_class = None
+    entries = dict(('css/%s.css' % i, '/static/css/%s.abc123.css' % i)
+                   for i in range(20))
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(
+            ECSTATIC_MANIFEST_FILE=os.path.join(self.root, 'manifest'))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def write_manifest(self, entries=None, clear=True):
+        writer = self.manifest_class()
+        if clear:
+            writer.clear()
+        for name, url in (self.entries if entries is None
+                          else entries).items():
+            writer.add(name, url)
+        writer.flush()
+
+    def check_remove(self):
+        self.write_manifest()
+        writer = self.manifest_class()
+        writer.remove('css/1.css')
+        writer.remove('css/missing.css')
+        writer.add('css/2.css', '/static/css/2.def456.css')
+        writer.flush()
+        data = self.manifest_class().load()
+        self.assertEqual(len(data), len(self.entries) - 1)
+        self.assertNotIn('css/1.css', data)
+        self.assertEqual(data['css/2.css'], '/static/css/2.def456.css')
+
+
+class JsonManifestTest(ManifestTestCase):
+    manifest_class = JsonManifest
+
+    def setUp(self):
+        super(JsonManifestTest, self).setUp()
+        self.manifest = JsonManifest()
+        self.cache = CountingCache(self.manifest._get_cache())
+        self.cache.clear()
+        self.manifest._get_cache = lambda: self.cache
+
+    def test_populates_cache_once(self):
+        self.write_manifest()
+        self.assertEqual(self.manifest.get('css/1.css'),
+                         '/static/css/1.abc123.css')
+        writes = self.cache.writes
+        self.assertTrue(writes)
+
+        self.assertEqual(self.manifest.get_many(['css/2.css', 'css/3.css']),
+                         {'css/2.css': '/static/css/2.abc123.css',
+                          'css/3.css': '/static/css/3.abc123.css'})
+        for i in range(3):
+            self.assertRaises(NotInManifest, self.manifest.get,
+                              'css/missing.css')
+        self.assertRaises(NotInManifest, self.manifest.get_many,
+                          ['css/4.css', 'css/missing.css'])
+        self.assertEqual(self.cache.writes, writes)
+
+    def test_new_generation(self):
+        self.write_manifest()
+        self.manifest.get('css/1.css')
+        self.write_manifest({'css/1.css': '/static/css/1.def456.css'})
+        self.manifest._stat_checked = None
+        self.assertEqual(self.manifest.get('css/1.css'),
+                         '/static/css/1.def456.css')
+        self.assertRaises(NotInManifest, self.manifest.get, 'css/2.css')
+
+    def test_snapshot(self):
+        self.write_manifest()
+        with override_settings(ECSTATIC_MANIFEST_SNAPSHOT=True):
+            self.assertEqual(self.manifest.get('css/1.css'),
+                             '/static/css/1.abc123.css')
+            self.assertRaises(NotInManifest, self.manifest.get,
+                              'css/missing.css')
+        self.assertEqual(self.cache.writes, 0)
+
+    def test_incremental_flush(self):
+        self.write_manifest()
+        self.write_manifest({'css/new.css': '/static/css/new.css'},
+                            clear=False)
+        data = JsonManifest().load()
+        self.assertEqual(len(data), len(self.entries) + 1)
+        self.assertEqual(data['css/new.css'], '/static/css/new.css')
+
+    def test_remove(self):
+        self.check_remove()
+
+    def test_generation_header(self):
+        self.write_manifest()
+        with open(os.path.join(self.root, 'manifest')) as file:
+            self.assertTrue(file.readline().startswith('{"generation": "'))
+        self.assertEqual(self.manifest._read_generation(),
+                         self.manifest._read()[0])
+
+    def test_warm_hits_skip_parsing(self):
+        self.write_manifest()
+        self.manifest.get('css/1.css')
+
+        # Another process, finding the cache already filled.
+        manifest = JsonManifest()
+        manifest._get_cache = lambda: self.cache
+
+        def read():
+            self.fail('The manifest entries were parsed.')
+        manifest._read = read
+        self.assertEqual(manifest.get('css/2.css'), '/static/css/2.abc123.css')
+        self.assertEqual(manifest.get_many(['css/3.css']),
+                         {'css/3.css': '/static/css/3.abc123.css'})
+        self.assertRaises(NotInManifest, manifest.get, 'css/missing.css')
+        self.assertEqual(manifest._state[2], None)
+
+        # The filling process lets go of its copy too.
+        self.assertEqual(self.manifest.get('css/2.css'),
+                         '/static/css/2.abc123.css')
+        self.assertEqual(self.manifest._state[2], None)
+
+    def test_manifest_without_header(self):
+        with open(os.path.join(self.root, 'manifest'), 'w') as file:
+            file.write('{"css/1.css": "/static/css/1.abc123.css"}')
+        self.assertEqual(self.manifest.get('css/1.css'),
+                         '/static/css/1.abc123.css')
+        self.assertEqual(self.manifest._read_generation(),
+                         self.manifest._read()[0])
+
+
+class BinaryManifestTest(ManifestTestCase):
+    manifest_class = BinaryManifest
+
+    def test_finds_every_entry(self):
+        entries = dict(self.entries)
+        entries[u'img/caf\xe9.png'] = u'/static/img/caf\xe9.png'
+        entries[u'img/z.png'] = u'/static/img/z.png'
+        self.write_manifest(entries)
+        manifest = BinaryManifest()
+        for name, url in entries.items():
+            self.assertEqual(manifest.get(name), url)
+
+    def test_misses(self):
+        self.write_manifest({'b': '/static/b', 'd': '/static/d'})
+        manifest = BinaryManifest()
+        # Before the first entry, between two entries and after the last.
+        for name in ('a', 'c', 'e', '', 'bb'):
+            self.assertRaises(NotInManifest, manifest.get, name)
+
+    def test_empty(self):
+        self.write_manifest({})
+        self.assertRaises(NotInManifest, BinaryManifest().get, 'a')
+        self.assertEqual(BinaryManifest().load(), {})
+
+    def test_load_and_incremental_flush(self):
+        self.write_manifest()
+        self.assertEqual(BinaryManifest().load(), self.entries)
+        self.write_manifest({'css/1.css': '/static/css/1.def456.css'},
+                            clear=False)
+        data = BinaryManifest().load()
+        self.assertEqual(len(data), len(self.entries))
+        self.assertEqual(data['css/1.css'], '/static/css/1.def456.css')
+
+    def test_remove(self):
+        self.check_remove()
+
+    def test_remaps_replaced_file(self):
+        self.write_manifest({'a': '/static/a.1'})
+        manifest = BinaryManifest()
+        self.assertEqual(manifest.get('a'), '/static/a.1')
+        self.write_manifest({'a': '/static/a.2', 'b': '/static/b'})
+        manifest._stat_checked = None
+        self.assertEqual(manifest.get('a'), '/static/a.2')
+        self.assertEqual(manifest.get_many(['a', 'b']),
+                         {'a': '/static/a.2', 'b': '/static/b'})
+
+    def test_rejects_other_files(self):
+        with open(os.path.join(self.root, 'manifest'), 'wb') as file:
+            file.write(b'{"a": "/static/a"}')
+        self.assertRaises(ValueError, BinaryManifest().get, 'a')
+
+
+class SqliteManifestTest(ManifestTestCase):
+    manifest_class = SqliteManifest
+
+    def test_get(self):
+        self.write_manifest()
+        manifest = SqliteManifest()
+        for name, url in self.entries.items():
+            self.assertEqual(manifest.get(name), url)
+        self.assertRaises(NotInManifest, manifest.get, 'css/missing.css')
+
+    def test_get_many_in_chunks(self):
+        entries = dict(('js/%s.js' % i, '/static/js/%s.js' % i)
+                       for i in range(1200))
+        self.write_manifest(entries)
+        manifest = SqliteManifest()
+        self.assertEqual(manifest.get_many(list(entries)), entries)
+        self.assertRaises(NotInManifest, manifest.get_many,
+                          ['js/1.js', 'js/missing.js'])
+
+    def test_load_and_incremental_flush(self):
+        self.assertEqual(SqliteManifest().load(), {})
+        self.write_manifest()
+        self.write_manifest({'css/1.css': '/static/css/1.def456.css'},
+                            clear=False)
+        data = SqliteManifest().load()
+        self.assertEqual(len(data), len(self.entries))
+        self.assertEqual(data['css/1.css'], '/static/css/1.def456.css')
+        self.write_manifest({'a': '/static/a'})
+        self.assertEqual(SqliteManifest().load(), {'a': '/static/a'})
+
+    def test_remove(self):
+        self.check_remove()
+
+    def test_unusual_path(self):
+        directory = os.path.join(self.root, 'a?b#c%20d')
+        os.mkdir(directory)
+        # A database at the path the unquoted URI would point to.
+        with override_settings(
+                ECSTATIC_MANIFEST_FILE=os.path.join(self.root, 'a')):
+            self.write_manifest({'a': '/static/wrong'})
+        with override_settings(
+                ECSTATIC_MANIFEST_FILE=os.path.join(directory, 'manifest')):
+            self.write_manifest({'a': '/static/a'})
+            self.assertEqual(SqliteManifest().get('a'), '/static/a')